@@ -0,0 +1,217 @@
+# coding: utf8
+""" 性能测试, 不需要数据库
+    run: python bench.py [--sizes 1,1000,100000] [--latency 0.0005] [--json bench_output.txt]
+    run: python bench.py --micro  # 只运行对象构建和 dictify 的对比测试
+"""
+
+import sys
+import json
+import time
+import argparse
+import datetime
+
+from tornorm import Base
+
+
+ROWS = [
+    'id', 'title', 'content', 'type', 'ins_time', 'status', 'user_id', 'image',
+    'last_answer_time', 'last_answer_id', 'max_answer_like', 'answer_count', 'fix_time'
+]
+
+
+class Question(Base):
+
+    _table_name = 'question'
+    _rows = ROWS
+
+
+class FakeConnection(object):
+    """ 与 torndb.Connection 接口相同的内存连接, 返回预设的行, 每次调用等待 latency 秒模拟网络和数据库耗时
+    """
+
+    def __init__(self, rows=None, latency=0):
+        self.rows = rows or []
+        self.latency = latency
+        self.calls = 0
+        self.lastrowid = 0
+
+    def _wait(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def execute(self, query, *parameters, **kwparameters):
+        return self.execute_lastrowid(query, *parameters, **kwparameters)
+
+    def execute_lastrowid(self, query, *parameters, **kwparameters):
+        self._wait()
+        self.lastrowid += 1
+        return self.lastrowid
+
+    def execute_rowcount(self, query, *parameters, **kwparameters):
+        self._wait()
+        return len(self.rows)
+
+    def query(self, query, *parameters, **kwparameters):
+        self._wait()
+        return list(self.rows)
+
+    def get(self, query, *parameters, **kwparameters):
+        self._wait()
+        if query.startswith('SELECT COUNT(*)'):
+            return {'COUNT(*)': len(self.rows)}
+        return self.rows[0] if self.rows else None
+
+    def iter(self, query, *parameters, **kwparameters):
+        self._wait()
+        return iter(self.rows)
+
+    def reconnect(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class DictQuestion(object):
+    """ 列数据存放在实例字典中的旧实现, 作为对照
+    """
+
+    _rows = ROWS
+    _dirty_data = {}
+
+    def __init__(self, data):
+        for k in data:
+            if k in self._rows:
+                self.__setattr__(k, data[k])
+        self._dirty_data.clear()
+
+    def __setattr__(self, key, value):
+        object.__setattr__(self, key, value)
+        if key in self._rows:
+            self._dirty_data[key] = value
+
+
+def make_rows(n):
+    now = datetime.datetime.now()
+    return [dict(id=i, title=u'问题标题', content=u'问题内容', type=1, ins_time=now, status=1, user_id='hello',
+                 image='', last_answer_time=now, last_answer_id=i, max_answer_like=0, answer_count=0,
+                 fix_time=now)
+            for i in range(n)]
+
+
+def timeit(fn, repeat=3):
+    """ 取多次运行的最短时间
+    """
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        fn()
+        t = time.time() - start
+        best = t if best is None else min(best, t)
+    return best
+
+
+def sizeof(objs):
+    """ 对象本身及其实例字典占用的字节数, 不含列的值
+    """
+    total = 0
+    for o in objs:
+        total += sys.getsizeof(o)
+        if isinstance(o, DictQuestion):
+            total += sys.getsizeof(o.__dict__)
+    return total
+
+
+def bench_hydrate(n=100000):
+    rows = make_rows(n)
+    results = [
+        ('hydrate dict __init__', timeit(lambda: [DictQuestion(d) for d in rows]),
+         sizeof([DictQuestion(d) for d in rows])),
+        ('hydrate slots __init__', timeit(lambda: [Question(d) for d in rows]),
+         sizeof([Question(d) for d in rows])),
+        ('hydrate slots _from_rows', timeit(lambda: Question._from_rows(rows)),
+         sizeof(Question._from_rows(rows))),
+    ]
+    print 'rows: %s' % n
+    for name, t, size in results:
+        print '%-30s %8.4f s %12d bytes' % (name, t, size)
+
+
+def bench_dictify(n=10000):
+    objs = Question._from_rows(make_rows(n))
+    fields = ['id', 'title', 'status', 'ins_time']
+    results = [
+        ('dictify per row', timeit(lambda: [o.dictify() for o in objs])),
+        ('dictify_many', timeit(lambda: Question.dictify_many(objs))),
+        ('dictify per row fields', timeit(lambda: [o.dictify(fields=fields) for o in objs])),
+        ('dictify_many fields', timeit(lambda: Question.dictify_many(objs, fields=fields))),
+        ('json.dumps per row dictify', timeit(lambda: json.dumps([o.dictify() for o in objs]))),
+        ('dumps_many', timeit(lambda: Question.dumps_many(objs))),
+    ]
+    print 'rows: %s' % n
+    for name, t in results:
+        print '%-30s %8.4f s' % (name, t)
+
+
+def run_suite(sizes=(1, 1000, 100000), latency=0, repeat=3):
+    """ 用内存连接测试各个操作在不同行数下的耗时, 连接的模拟耗时计入结果
+        return: [{'name', 'rows', 'seconds', 'per_row_us', 'calls'}, ...]
+    """
+    conn = Question._db_conn = FakeConnection(latency=latency)
+    results = []
+
+    def record(name, n, fn):
+        calls = conn.calls
+        t = timeit(fn, repeat)
+        results.append({'name': name, 'rows': n, 'seconds': t, 'per_row_us': t / n * 1e6,
+                        'calls': (conn.calls - calls) // repeat})
+
+    for n in sizes:
+        rows = make_rows(n)
+        conn.rows = rows[:1]
+        ids = range(n)
+        record('build find sql', n, lambda: [Question.find(user_id='hello', status=1, id__in=[i, i + 1],
+                                                           commit=False) for i in ids])
+        record('get', n, lambda: [Question.get(id=i) for i in ids])
+        conn.rows = rows
+        record('find hydrate', n, lambda: Question.find(status=1))
+        record('find columnar', n, lambda: Question.find(status=1, columnar=True))
+        objs = Question.find(status=1)
+        record('dictify per row', n, lambda: [o.dictify() for o in objs])
+        record('dictify_many', n, lambda: Question.dictify_many(objs))
+        record('dumps_many', n, lambda: Question.dumps_many(objs))
+        items = [dict((k, v) for k, v in d.items() if k != 'id') for d in rows]
+        record('new_mul', n, lambda: Question.new_mul(True, *items))
+        conn.rows = make_rows(n + 1)
+        record('paginate exact', n, lambda: Question.paginate(2, per_page=n))
+        record('paginate has_next', n, lambda: Question.paginate(2, per_page=n, count='has_next'))
+    Question._db_conn = None
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='TornOrm offline benchmarks')
+    parser.add_argument('--sizes', default='1,1000,100000', help='comma separated row counts')
+    parser.add_argument('--latency', type=float, default=0, help='simulated seconds per database call')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', help='write machine readable results to this file')
+    parser.add_argument('--micro', action='store_true', help='only run hydrate/dictify comparisons')
+    args = parser.parse_args()
+    if args.micro:
+        bench_hydrate()
+        bench_dictify()
+        return
+    sizes = [int(s) for s in args.sizes.split(',')]
+    results = run_suite(sizes, args.latency, args.repeat)
+    for r in results:
+        print '%-22s %8d rows %10.4f s %10.2f us/row %6d calls' % (
+            r['name'], r['rows'], r['seconds'], r['per_row_us'], r['calls'])
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'latency': args.latency, 'repeat': args.repeat,
+                       'time': datetime.datetime.now().isoformat(), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -15,5 +15,6 @@ setup(
     author_email='hatcatxyz@gmail.com',
     description='A simple ORM base on Torndb',
     py_modules=['tornorm', ],
-    install_requires=['torndb', ],
+    # 异步方法和 parallel_scan 使用 concurrent.futures, Python 2 需要 futures 包
+    install_requires=['torndb', 'futures; python_version < "3"'],
 )
@@ -5,9 +5,17 @@
 # before run this test you must create database first
 # run: create database test default character set utf8  # in mysql-client
 
+import json
+import time
+import pickle
+import datetime
+import threading
 import unittest
+from concurrent.futures import Future, ThreadPoolExecutor
 from torndb import Connection
-from tornorm import Base, set_
+from tornorm import Base, set_, get_connection, TooManyConnections, CacheBackend, LRUCache, SqlValueError, \
+    ReplicaSet, add_listener, remove_listener, QueryStats, fingerprint, \
+    detect_n_plus_one, ForeignKey, HasMany, CounterBuffer
 
 
 _CONNS_ = {}
@@ -38,6 +46,819 @@ class TestOrm(Base):
         return get_conn('test', pre_sqls=('set names utf8mb4', ))
 
 
+class FakeConnection(object):
+    """ 不依赖数据库的 torndb.Connection 替身
+    """
+
+    def __init__(self, rows=None):
+        self.rows = rows or []
+        self.executed = []
+        self.gone_away = 0  # 接下来几次调用抛出 gone away
+        self.closed = False
+
+    def _run(self, sql, values):
+        if self.gone_away:
+            self.gone_away -= 1
+            raise Exception(2006, 'MySQL server has gone away')
+        self.executed.append((sql, values))
+
+    def execute(self, sql, *values):
+        self._run(sql, values)
+        return len(self.executed)
+
+    execute_lastrowid = execute
+
+    def execute_rowcount(self, sql, *values):
+        self._run(sql, values)
+        return len(self.rows)
+
+    def query(self, sql, *values):
+        self._run(sql, values)
+        return list(self.rows)
+
+    def get(self, sql, *values):
+        self._run(sql, values)
+        return self.rows[0] if self.rows else None
+
+    def iter(self, sql, *values):
+        self._run(sql, values)
+        for row in self.rows:
+            yield row
+
+    def ping(self):
+        pass
+
+    def reconnect(self):
+        self.executed = []
+
+    def close(self):
+        self.closed = True
+
+
+class PoolTest(unittest.TestCase):
+
+    def test_pre_exe(self):
+        pool = get_connection(host='localhost', database='test', creator=FakeConnection, mincached=2,
+                              pre_exe=('set names utf8mb4', ))
+        with pool.connection() as con:
+            self.assertEqual(con.executed, [('set names utf8mb4', ())])
+        pool.execute('select 1')
+        self.assertEqual(pool.stats()['created'], 2)
+        self.assertEqual(pool.stats()['checkouts'], 2)
+
+    def test_max_connections(self):
+        pool = get_connection(host='localhost', database='test', creator=FakeConnection, maxconnections=1,
+                              timeout=0.05)
+        with pool.connection():
+            self.assertRaises(TooManyConnections, pool.execute, 'select 1')
+        pool.execute('select 1')
+        self.assertEqual(pool.stats()['size'], 1)
+
+    def test_reconnect(self):
+        pool = get_connection(host='localhost', database='test', creator=FakeConnection,
+                              pre_exe=('set names utf8mb4', ))
+        with pool.connection() as con:
+            con.gone_away = 1
+        pool.execute('select 1')
+        self.assertEqual(con.executed, [('set names utf8mb4', ()), ('select 1', ())])
+        self.assertEqual(pool.stats()['reconnects'], 1)
+
+    def test_model_route(self):
+        pool = get_connection(host='localhost', database='test', creator=lambda: FakeConnection([{'id': 1}]))
+
+        class PoolOrm(Base):
+            _table_name = 'test_orm'
+            _rows = TestOrm._rows
+            _db_conn = pool
+
+        rs = PoolOrm.find(id=1)
+        self.assertEqual(rs[0].id, 1)
+        self.assertEqual(pool.stats()['in_use'], 0)
+
+
+class AsyncDriver(FakeConnection):
+    """ 非阻塞驱动替身, 每个方法返回已完成的 Future
+    """
+    is_async = True
+
+    def __getattribute__(self, name):
+        attr = object.__getattribute__(self, name)
+        if name not in ('execute', 'execute_rowcount', 'query', 'get'):
+            return attr
+
+        def call(sql, *values):
+            future = Future()
+            future.set_result(attr(sql, *values))
+            return future
+        return call
+
+
+class SlowConnection(FakeConnection):
+    """ 写操作较慢的替身连接, 异步写在执行线程上完成后才回调
+    """
+
+    def execute(self, sql, *values):
+        time.sleep(0.05)
+        return FakeConnection.execute(self, sql, *values)
+
+
+class AsyncTest(unittest.TestCase):
+
+    def _model(self, con):
+        class AsyncOrm(Base):
+            _table_name = 'test_orm'
+            _rows = TestOrm._rows
+            _db_conn = con
+        return AsyncOrm
+
+    def test_executor(self):
+        model = self._model(FakeConnection([{'id': 1, 'name': 'test0'}]))
+        # 线程池中执行时必须使用连接池
+        self.assertRaises(SqlValueError, model.afind, name='test0')
+        model = self._model(get_connection(host='localhost', database='test',
+                                           creator=lambda: FakeConnection([{'id': 1, 'name': 'test0'}])))
+        rs = model.afind(name='test0').result(1)
+        self.assertEqual(rs[0].name, 'test0')
+        o = model.aget(id=1).result(1)
+        self.assertEqual(o.id, 1)
+        self.assertEqual(model.anumber().result(1), 0)
+
+    def test_async_driver(self):
+        con = AsyncDriver([{'id': 1, 'name': 'test0'}])
+        model = self._model(con)
+        o = model.anew(name='test0').result(1)
+        self.assertEqual(o.name, 'test0')
+        self.assertTrue(con.executed[0][0].startswith('INSERT INTO `test_orm`'))
+        o = o.aupdate(name='test1').result(1)
+        self.assertEqual(o.name, 'test1')
+        rs = model.apage(1, per_page=5).result(1)
+        self.assertEqual(len(rs), 1)
+
+    def test_read_your_writes(self):
+        replica = FakeConnection([{'id': 1, 'name': 'test0'}])
+        model = self._model(get_connection(host='localhost', database='test',
+                                           creator=lambda: SlowConnection([{'id': 1, 'name': 'test0'}])))
+        model._db_replicas = [replica]
+        model._refetch_on_new = False
+        model.anew(name='test1').result(1)
+        # 写入时间记在发起调用的线程上, 之后的读走主库
+        model.get(id=1)
+        self.assertEqual(replica.executed, [])
+
+    def test_refetch_on_primary(self):
+        model = self._model(get_connection(host='localhost', database='test',
+                                           creator=lambda: SlowConnection([{'id': 1, 'name': 'test1'}])))
+        # 从库还没有同步新插入的行
+        model._db_replicas = [get_connection(host='localhost', database='test', creator=FakeConnection)]
+        o = model.anew(name='test1').result(1)
+        self.assertEqual((o.id, o.name), (1, 'test1'))
+
+
+class ScanConnection(FakeConnection):
+    """ 按 BETWEEN 参数过滤行的替身连接, fail 中的分区下界查询时抛出异常
+    """
+
+    fail = []
+
+    def get(self, sql, *values):
+        self._run(sql, values)
+        ids = [r['id'] for r in self.rows]
+        return {'lo': min(ids) if ids else None, 'hi': max(ids) if ids else None}
+
+    def query(self, sql, *values):
+        self._run(sql, values)
+        lo, hi = values[-2:]
+        if lo in self.fail:
+            self.fail.remove(lo)
+            raise Exception('partition failed')
+        return [r for r in self.rows if lo <= r['id'] <= hi]
+
+
+class CountingExecutor(ThreadPoolExecutor):
+    """ 记录提交次数的线程池
+    """
+
+    submitted = 0
+
+    def submit(self, fn, *args, **kwargs):
+        self.submitted += 1
+        return ThreadPoolExecutor.submit(self, fn, *args, **kwargs)
+
+
+class DictCache(CacheBackend):
+    """ 外部缓存替身
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value, ttl=None):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+class FakeOrm(Base):
+
+    _table_name = 'test_orm'
+    _rows = TestOrm._rows
+    _db_conn = FakeConnection()
+
+    owner = ForeignKey('FakeUser', 'type')
+
+
+class FakeUser(Base):
+
+    _table_name = 'test_user'
+    _rows = ['id', 'name']
+    _db_conn = FakeConnection()
+
+    items = HasMany(FakeOrm, 'type', order_by='id')
+
+
+class FakeDbTest(unittest.TestCase):
+    """ 使用替身连接, 检查生成的语句
+    """
+
+    def setUp(self):
+        self.conn = FakeOrm._db_conn = FakeConnection([{'id': 1, 'name': 'test0', 'content': 'test', 'type': 1}])
+        FakeOrm._state_obj = None  # 重置缓存统计
+
+    def test_new_no_refetch(self):
+        o = FakeOrm.new(refetch=False, name='test0')
+        self.assertEqual(len(self.conn.executed), 1)
+        self.assertEqual(o.id, 1)
+        self.assertEqual(o.name, 'test0')
+        self.assertEqual(o.content, None)
+        o = FakeOrm.new(name='test0')
+        self.assertEqual(len(self.conn.executed), 3)
+
+    def test_bulk_insert_objects(self):
+        rs = FakeOrm.bulk_insert([{'name': 'a'}, {'name': 'b'}], as_objects=True)
+        o = rs[0]['objects'][1]
+        self.assertEqual((o.id, o.name), (2, 'b'))
+        # 未提供的列为 None
+        self.assertEqual(o.content, None)
+
+    def test_new_default_rows(self):
+        FakeOrm._default_rows = ('type', )
+        try:
+            o = FakeOrm.new(refetch=False, name='test0')
+        finally:
+            FakeOrm._default_rows = ()
+        self.assertEqual(o.type, 1)
+        self.assertEqual(self.conn.executed[1][0], 'SELECT `type` FROM `test_orm` WHERE  (`id`=%s)  LIMIT 1')
+
+    def test_dirty(self):
+        a = FakeOrm.get(id=1)
+        b = FakeOrm.get(id=1)
+        a.name = 'test1'
+        self.assertEqual(b.changed_data(), {})
+        b.save()
+        a.name = 'test0'
+        a.save()
+        self.assertEqual(len(self.conn.executed), 2)
+        a.name = 'test2'
+        a.save()
+        self.assertEqual(self.conn.executed[-1][1], ('test2', ))
+        self.assertEqual(a.changed_data(), {})
+
+    def test_find_iter(self):
+        self.conn.rows = [{'id': i, 'name': 'test%s' % i} for i in range(5)]
+        rows = list(FakeOrm.find_iter(batch_size=2, row_type='model'))
+        self.assertEqual([o.id for o in rows], range(5))
+        rows = list(FakeOrm.find_iter(fields=['id', 'name'], row_type='tuple'))
+        self.assertEqual(rows[1], (1, 'test1'))
+        # 提前关闭时丢弃连接池借出的连接
+        pool = get_connection(host='localhost', database='test', creator=lambda: self.conn)
+        FakeOrm._db_conn = pool
+        with FakeOrm.find_iter(batch_size=2) as rows:
+            self.assertEqual(next(rows)['id'], 0)
+            self.assertEqual(pool.stats()['in_use'], 1)
+        self.assertEqual(pool.stats()['size'], 0)
+        self.assertEqual(len(list(FakeOrm.find_iter())), 5)
+        self.assertEqual(pool.stats()['idle'], 1)
+
+    def test_find_iter_keyset(self):
+        self.conn.rows = [{'id': i, 'name': 'test%s' % i} for i in range(3)]
+        rows = list(FakeOrm.find_iter(batch_size=2, keyset=True, limit=3))
+        self.assertEqual(len(rows), 3)
+        self.assertTrue(self.conn.executed[-1][0].endswith('WHERE (`id`) > (%s) ORDER BY `id` LIMIT %s'))
+        self.assertEqual(self.conn.executed[-1][1], (1, 2))
+
+    def test_row_cache(self):
+        FakeOrm._row_cache = LRUCache(100)
+        try:
+            self.assertEqual(FakeOrm.get(id=1).name, 'test0')
+            self.assertEqual(FakeOrm.get(id=1).name, 'test0')
+            self.assertEqual(len(self.conn.executed), 1)
+            o = FakeOrm.get(id=1)
+            o.update(name='test1')
+            FakeOrm.get(id=1)
+            self.assertEqual(len(self.conn.executed), 3)
+            FakeOrm.get(id=1, fields=['name'])
+            self.assertEqual(len(self.conn.executed), 4)
+            info = FakeOrm.row_cache_info()
+        finally:
+            FakeOrm._row_cache = None
+        self.assertEqual((info['hits'], info['misses'], info['invalidations']), (2, 2, 1))
+
+    def test_row_cache_negative(self):
+        FakeOrm._row_cache = DictCache()
+        FakeOrm._row_cache_keys = ('id', 'name')
+        try:
+            self.conn.rows = []
+            self.assertEqual(FakeOrm.get(name='test0'), None)
+            self.assertEqual(FakeOrm.get(name='test0'), None)
+            self.assertEqual(len(self.conn.executed), 1)
+            FakeOrm.new(refetch=False, name='test0')
+            self.conn.rows = [{'id': 2, 'name': 'test0'}]
+            self.assertEqual(FakeOrm.get(name='test0').id, 2)
+            FakeOrm.get(id=2)
+            FakeOrm.delete(id=2)
+            FakeOrm.get(name='test0')
+            self.assertEqual(len(self.conn.executed), 6)
+            info = FakeOrm.row_cache_info()
+        finally:
+            FakeOrm._row_cache = None
+            FakeOrm._row_cache_keys = ('id', )
+        self.assertEqual(info['negative_hits'], 1)
+
+    def test_row_cache_shared_backend(self):
+        # 两个进程(各自的模型状态)共享同一个缓存后端
+        FakeOrm._row_cache = LRUCache(100)
+        try:
+            self.assertEqual(FakeOrm.get(id=1).name, 'test0')
+            local = FakeOrm._state_obj
+            FakeOrm._state_obj = None
+            self.conn.rows = [{'id': 1, 'name': 'new'}]
+            FakeOrm.cls_update(set_(name='new'), name='test0')
+            FakeOrm._state_obj = local
+            self.assertEqual(FakeOrm.get(id=1).name, 'new')
+            generation = FakeOrm._row_cache.get(FakeOrm._table_name + ':rgen')
+            FakeOrm.cls_update(set_(name='newer'), id=1)
+            self.conn.rows = [{'id': 1, 'name': 'newer'}]
+            self.assertEqual(FakeOrm.get(id=1).name, 'newer')
+            self.assertEqual(FakeOrm._row_cache.get(FakeOrm._table_name + ':rgen'), generation)
+        finally:
+            FakeOrm._row_cache = None
+
+    def test_get_many(self):
+        self.conn.rows = [{'id': 3, 'name': 'test3'}, {'id': 1, 'name': 'test1'}]
+        rs = FakeOrm.get_many([1, 2, 3, 1], chunk_size=2)
+        self.assertEqual(rs.keys(), [1, 2, 3])
+        self.assertEqual(rs[1].name, 'test1')
+        self.assertEqual(rs[2], None)
+        self.assertEqual([len(v) for s, v in self.conn.executed], [2, 1])
+        FakeOrm._row_cache = LRUCache(100)
+        try:
+            FakeOrm.get_many([1, 2])
+            rs = FakeOrm.get_many([1, 2, 3])
+            self.assertEqual(FakeOrm.get(id=3).name, 'test3')
+        finally:
+            FakeOrm._row_cache = None
+        self.assertEqual(rs[1].name, 'test1')
+        self.assertEqual(self.conn.executed[-1][1], (3, ))
+
+    def test_operators(self):
+        sql, values = FakeOrm.find(id__in=[1, 2, 3], name__startswith='te_', type__between=(1, 2),
+                                   content__isnull=True, commit=False)
+        self.assertEqual(sql, 'SELECT `id`,`name`,`content`,`type` FROM `test_orm`  WHERE  (`content` IS NULL and '
+                              '`id` IN (%s,%s,%s,%s) and `name` LIKE %s and `type` BETWEEN %s AND %s) ')
+        self.assertEqual(values, [1, 2, 3, 3, 'te\\_%', 1, 2])
+        FakeOrm.find(id__notin=[1, 2, 3, 4], commit=False)
+        info = FakeOrm.stmt_cache_info()
+        FakeOrm.find(id__notin=[1, 2, 3], commit=False)
+        self.assertEqual(FakeOrm.stmt_cache_info()['hits'], info['hits'] + 1)
+        self.assertRaises(SqlValueError, FakeOrm.find, id__in=[])
+        # 集合和生成器转为列表后补齐
+        sql, values = FakeOrm.find(id__in=set([1, 2, 3]), commit=False)
+        self.assertEqual((len(values), sorted(set(values))), (4, [1, 2, 3]))
+        sql, values = FakeOrm.delete(id__notin=(i for i in [1, 2, 3]), commit=False)
+        self.assertEqual(values, [1, 2, 3, 3])
+        self.assertRaises(SqlValueError, FakeOrm.find, name__in='abc')
+        self.assertRaises(SqlValueError, FakeOrm.find, name__startswith=['a', 'b'])
+        self.assertRaises(SqlValueError, FakeOrm.find, name__startswith=[])
+
+    def test_replicas(self):
+        r1, r2 = FakeConnection(self.conn.rows), FakeConnection(self.conn.rows)
+        FakeOrm._db_replicas = ReplicaSet([r1, r2], max_lag=1, lag_fn=lambda con: 5 if con is r2 else 0)
+        try:
+            for i in range(3):
+                FakeOrm.get(id=1)
+            FakeOrm.find(name='test0')
+            self.assertEqual((len(r1.executed), len(r2.executed), len(self.conn.executed)), (4, 0, 0))
+            # 写操作之后读主库
+            FakeOrm.delete(id=2)
+            FakeOrm.get(id=1)
+            self.assertEqual(len(self.conn.executed), 2)
+            FakeOrm._ryw_window = 0
+            FakeOrm.begin()
+            FakeOrm.get(id=1)
+            FakeOrm.commit()
+            self.assertEqual(len(self.conn.executed), 5)
+            # 从库连接断开时回退到主库
+            r1.gone_away = 1
+            self.assertEqual(FakeOrm.get(id=1).id, 1)
+            self.assertEqual(len(self.conn.executed), 6)
+            self.assertEqual(FakeOrm.replica_info()['replicas'][0]['errors'], 1)
+        finally:
+            FakeOrm._db_replicas = None
+            FakeOrm._ryw_window = Base._ryw_window
+
+    def test_transaction(self):
+        pool = get_connection(host='localhost', database='test', creator=FakeConnection)
+        FakeOrm._db_conn = pool
+        with FakeOrm.transaction() as tx:
+            FakeOrm.new(refetch=False, name='test0')
+            tx.add(FakeOrm.new(commit=False, name='test1'))
+            tx.add(FakeOrm.new(commit=False, name='test2'))
+            with FakeOrm.transaction():
+                FakeOrm.delete(id=1)
+            try:
+                with FakeOrm.transaction() as sp:
+                    sp.add('DELETE FROM `test_orm`', [])
+                    raise ValueError
+            except ValueError:
+                pass
+            self.assertEqual(pool.stats()['in_use'], 1)
+        self.assertEqual(pool.stats()['in_use'], 0)
+        with pool.connection() as con:
+            sqls = [sql.split(' (')[0] for sql, values in con.executed]
+        self.assertEqual(sqls, [
+            'BEGIN', 'INSERT INTO `test_orm`', 'INSERT INTO `test_orm`',
+            'SAVEPOINT tornorm_sp_1', 'DELETE FROM `test_orm` WHERE ',
+            'RELEASE SAVEPOINT tornorm_sp_1', 'SAVEPOINT tornorm_sp_2', 'ROLLBACK TO SAVEPOINT tornorm_sp_2',
+            'COMMIT'])
+        # 排队的两条语句合并为一次执行
+        self.assertEqual(con.executed[2][0].count('INSERT'), 2)
+        try:
+            with FakeOrm.transaction():
+                FakeOrm.delete(id=1)
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(con.executed[-1][0], 'ROLLBACK')
+
+    def test_transaction_get_conn(self):
+        pool = get_connection(host='localhost', database='test', creator=FakeConnection)
+
+        class ConnOrm(Base):
+            _table_name = 'test_orm'
+            _rows = TestOrm._rows
+
+            @classmethod
+            def get_conn(cls):
+                return pool
+
+        with ConnOrm.transaction():
+            ConnOrm.delete(id=1)
+        # 重写 get_conn 时语句也在事务的连接上执行
+        with pool.connection() as con:
+            self.assertEqual([sql.split(' ')[0] for sql, values in con.executed], ['BEGIN', 'DELETE', 'COMMIT'])
+
+    def test_transaction_queued_model(self):
+        FakeOrm._db_conn = get_connection(host='localhost', database='test', creator=FakeConnection)
+        FakeUser._query_cache = LRUCache(100)
+        try:
+            FakeUser.find(name='a', cache=True)
+            version = FakeUser._query_cache.get('test_user:qver')
+            with FakeOrm.transaction() as tx:
+                tx.add(FakeUser.new(commit=False, name='b'))
+            self.assertNotEqual(FakeUser._query_cache.get('test_user:qver'), version)
+            version = FakeUser._query_cache.get('test_user:qver')
+            with FakeOrm.transaction() as tx:
+                tx.add('UPDATE `test_orm` SET name=%s', ['c'])
+            self.assertEqual(FakeUser._query_cache.get('test_user:qver'), version)
+            with FakeOrm.transaction() as tx:
+                tx.add('UPDATE `test_orm` SET name=%s', ['c'], model=FakeUser)
+            self.assertNotEqual(FakeUser._query_cache.get('test_user:qver'), version)
+        finally:
+            FakeUser._query_cache = None
+
+    def test_slots(self):
+        self.assertTrue('name' in FakeOrm.__slots__)
+        o = FakeOrm._from_rows(self.conn.rows)[0]
+        self.assertEqual(o.name, 'test0')
+        o.name = 'test1'
+        o.extra = 1
+        p = pickle.loads(pickle.dumps(o))
+        self.assertEqual((p.name, p.extra), ('test1', 1))
+        self.assertEqual(p.changed_data(), {'name': 'test1'})
+
+    def test_column_named_like_method(self):
+        class Doc(Base):
+            _table_name = 'doc'
+            _rows = ['id', 'page', 'number', 'name']
+            _db_conn = self.conn
+
+        self.assertFalse('page' in Doc.__slots__ or 'number' in Doc.__slots__)
+        self.assertTrue('name' in Doc.__slots__)
+        sql, values = Doc.page(1, commit=False)
+        self.assertEqual(values, [10, 0])
+        d = Doc({'id': 1, 'page': 3, 'number': 4, 'name': 'a'})
+        self.assertEqual((d.page, d.number, d.name), (3, 4, 'a'))
+        d.page = 5
+        self.assertEqual(d.changed_data(), {'page': 5})
+        self.assertEqual(Doc.number(commit=False)[0], 'SELECT COUNT(*) FROM `doc` ')
+
+    def test_save_all(self):
+        objs = [FakeOrm(dict(id=i, name='test', type=1)) for i in range(5)]
+        for o in objs:
+            o.name = 'test%s' % o.id
+        objs[0].type = 2
+        objs[4].name = 'test'
+        self.assertEqual(FakeOrm.save_all(objs), 2)
+        sql, values = self.conn.executed[-1]
+        self.assertEqual(sql, 'UPDATE `test_orm` SET `name`=CASE `id` WHEN %s THEN %s WHEN %s THEN %s WHEN %s THEN %s '
+                              'END WHERE `id` IN (%s,%s,%s)')
+        self.assertEqual(values, (1, 'test1', 2, 'test2', 3, 'test3', 1, 2, 3))
+        self.assertFalse([o for o in objs if o.changed_data()])
+
+    def test_listener(self):
+        events = []
+        stats = QueryStats()
+        add_listener(events.append)
+        add_listener(stats)
+        try:
+            FakeOrm.get(id=1)
+            FakeOrm.get(id=2)
+            FakeOrm.find(id__in=[1, 2, 3])
+        finally:
+            remove_listener(events.append)
+            remove_listener(stats)
+        FakeOrm.get(id=3)
+        self.assertEqual(len(events), 3)
+        self.assertEqual(events[0].model, FakeOrm)
+        self.assertEqual(events[0].method, 'get')
+        self.assertEqual(events[0].rows, 1)
+        self.assertTrue(events[0].call_site.startswith(__file__.rstrip('c')))
+        self.assertEqual(events[0].fingerprint, events[1].fingerprint)
+        self.assertEqual(fingerprint("select * from t where id in (%s,%s) and name='a' limit 10"),
+                         fingerprint("select * from t where id in (%s,%s,%s) and name='b' limit 20"))
+        report = stats.report()
+        self.assertEqual(sorted(st['count'] for st in report), [1, 2])
+        self.assertTrue(all(st['p50'] <= st['p99'] for st in report))
+
+    def test_listener_pool(self):
+        pool = get_connection(host='localhost', database='test', creator=FakeConnection)
+        FakeOrm._db_conn = pool
+        events = []
+        add_listener(events.append)
+        try:
+            FakeOrm.get(id=1)
+            with pool.connection() as con:
+                con.gone_away = 3
+            self.assertRaises(Exception, list, FakeOrm.find_iter(name='a'))
+        finally:
+            remove_listener(events.append)
+        # 记录借出的物理连接, 流式读取失败时带上异常
+        self.assertEqual(events[0].conn_id, id(con))
+        self.assertEqual(events[-1].mode, 'iter')
+        self.assertEqual(events[-1].error.args[0], 2006)
+
+    def test_n_plus_one(self):
+        hits = []
+        with detect_n_plus_one(threshold=3, callback=lambda e, n: hits.append(n)) as d:
+            for i in range(4):
+                FakeOrm.get(id=i)
+        self.assertEqual(hits, [3])
+        report = d.report()
+        self.assertEqual(len(report), 1)
+        self.assertEqual((report[0]['count'], report[0]['model'], report[0]['method']), (4, FakeOrm, 'get'))
+        self.conn.rows = [{'id': 3, 'name': 'test3'}, {'id': 1, 'name': 'test1'}]
+        del self.conn.executed[:]
+        with detect_n_plus_one(auto_batch=True):
+            objs = [FakeOrm.get(id=i) for i in (1, 2, 3)]
+            self.assertTrue(isinstance(objs[0], FakeOrm))
+            self.assertEqual(self.conn.executed, [])
+            self.assertEqual([o.name if o else None for o in objs], ['test1', None, 'test3'])
+        self.assertEqual(len(self.conn.executed), 1)
+        self.assertEqual(self.conn.executed[0][1][:3], (1, 2, 3))
+        self.assertEqual(type(FakeOrm.get(id=1)), FakeOrm)
+
+    def test_relations(self):
+        users = FakeUser._db_conn = FakeConnection([{'id': 7, 'name': 'u7'}])
+        self.conn.rows = [{'id': 1, 'name': 'a', 'type': 7}, {'id': 2, 'name': 'b', 'type': 8},
+                          {'id': 3, 'name': 'c', 'type': 7}]
+        qs = FakeOrm.find(prefetch_related=['owner'])
+        self.assertEqual(qs[0].owner.name, 'u7')
+        self.assertEqual(qs[1].owner, None)
+        self.assertEqual(len(users.executed), 1)
+        self.assertEqual(users.executed[0][1][:2], (7, 8))
+        self.assertEqual(qs[0].dictify(), {'id': 1, 'name': 'a', 'type': 7})
+        self.assertEqual(qs[0].dictify(properties=['owner'])['owner'], {'id': 7, 'name': 'u7'})
+
+        sql, values = FakeOrm.page(1, select_related='owner', name='a', commit=False)
+        self.assertEqual(sql, 'SELECT test_orm.`id`,test_orm.`name`,test_orm.`content`,test_orm.`type`,'
+                              '`owner`.`id` AS `owner__id`,`owner`.`name` AS `owner__name` FROM `test_orm`  '
+                              'LEFT JOIN `test_user` AS `owner` ON `owner`.`id`=`test_orm`.`type`  '
+                              'WHERE  (test_orm.`name`=%s)  LIMIT %s OFFSET %s')
+        self.conn.rows = [{'id': 1, 'type': 7, 'owner__id': 7, 'owner__name': 'u7'},
+                          {'id': 2, 'type': 8, 'owner__id': None, 'owner__name': None}]
+        del self.conn.executed[:]
+        qs = FakeOrm.find(select_related=['owner'])
+        self.assertEqual((qs[0].owner.name, qs[1].owner), ('u7', None))
+        self.assertEqual(len(self.conn.executed), 1)
+
+        self.conn.rows = [{'id': 1, 'type': 7}, {'id': 3, 'type': 7}]
+        u = FakeUser({'id': 7, 'name': 'u7'})
+        self.assertEqual([o.id for o in u.items], [1, 3])
+        self.assertEqual(self.conn.executed[-1], ('SELECT `id`,`name`,`content`,`type` FROM `test_orm`  WHERE  '
+                                                  '(`type`=%s)  ORDER BY id', (7, )))
+        FakeUser.prefetch([u, FakeUser({'id': 9})], 'items__owner')
+        self.assertEqual(u.items[0].owner.name, 'u7')
+
+    def test_paginate(self):
+        self.conn.rows = [{'id': 1, 'COUNT(*)': 10, 'rows': 300000, 'filtered': 50.0}, {'id': 2}, {'id': 3}]
+        items, total, has_next = FakeOrm.paginate(1, per_page=2, type=1)
+        self.assertEqual(([o.id for o in items], total, has_next), ([1, 2], 10, True))
+        self.assertEqual(self.conn.executed[-2][1], (1, 3, 0))
+        self.assertEqual(self.conn.executed[-1][0], 'SELECT COUNT(*) FROM `test_orm`  WHERE  (`type`=%s) ')
+        n = len(self.conn.executed)
+        self.assertEqual(FakeOrm.paginate(1, per_page=5)[1:], (3, False))
+        self.assertEqual(FakeOrm.paginate(2, per_page=2, count='has_next')[1:], (None, True))
+        self.assertEqual(len(self.conn.executed), n + 2)
+        for i in range(2):
+            self.assertEqual(FakeOrm.paginate(2, per_page=2, count='cached')[1], 10)
+        self.assertEqual(len(self.conn.executed), n + 5)
+        FakeOrm.cls_update(set_(name='x'), id=1)
+        FakeOrm.paginate(2, per_page=2, count='cached')
+        self.assertEqual(self.conn.executed[-1][0], 'SELECT COUNT(*) FROM `test_orm` ')
+        self.assertEqual(FakeOrm.count_cache_info()['hits'], 1)
+        self.assertEqual(FakeOrm.paginate(2, per_page=2, count='approx')[1], 150000)
+        self.assertEqual(self.conn.executed[-1][0], 'EXPLAIN SELECT 1 FROM `test_orm` ')
+
+    def test_only_defer(self):
+        self.conn.rows = [{'id': 1, 'name': 'a'}, {'id': 2, 'name': 'b'}]
+        qs = FakeOrm.find(only=['name'], type=1)
+        self.assertEqual(self.conn.executed[-1][0], 'SELECT `id`,`name` FROM `test_orm`  WHERE  (`type`=%s) ')
+        self.assertEqual(qs[0].dictify(), {'id': 1, 'name': 'a'})
+        qs[1].type = 3
+        self.conn.rows = [{'id': 2, 'content': 'c2', 'type': 2}, {'id': 1, 'content': 'c1', 'type': 1}]
+        n = len(self.conn.executed)
+        self.assertEqual(qs[0].content, 'c1')
+        self.assertEqual((qs[1].content, qs[1].type), ('c2', 3))
+        self.assertEqual(len(self.conn.executed), n + 1)
+        self.assertEqual(self.conn.executed[-1][0][:46], 'SELECT `id`,`content`,`type` FROM `test_orm`  ')
+        self.assertEqual(qs[1].changed_data(), {'type': 3})
+        sql, values = FakeOrm.get(defer='content', id=1, commit=False)
+        self.assertEqual(sql, 'SELECT `id`,`name`,`type` FROM `test_orm` WHERE  (`id`=%s)  LIMIT 1')
+        self.assertRaises(SqlValueError, FakeOrm.find, only=['title'])
+        o = FakeOrm({'id': 1})
+        self.assertRaises(AttributeError, getattr, o, 'name')
+
+    def test_dictify_many(self):
+        now = datetime.datetime(2020, 1, 2, 3, 4, 5)
+        objs = [FakeOrm({'id': 1, 'name': 'a', 'content': now, 'type': 1}), FakeOrm({'id': 2, 'name': 'b'})]
+        objs[1].extra = 'x'
+        objs[1]._hidden = 'y'
+        for kw in ({}, {'fields': ['id', 'content']}, {'fields': ['name', 'extra'], 'properties': ['type']},
+                   {'convert_date': False}, {'properties': ['owner']}):
+            self.assertEqual(FakeOrm.dictify_many(objs, **kw), [o.dictify(**kw) for o in objs])
+        self.assertEqual(json.loads(FakeOrm.dumps_many(objs, fields=['id', 'content'])),
+                         [{'id': 1, 'content': '2020-01-02 03:04:05'}, {'id': 2}])
+
+    def test_incr(self):
+        self.assertEqual(FakeOrm.incr(1, type=2, commit=False),
+                         ('UPDATE `test_orm` SET `type`=`type`+%s WHERE `id` IN (%s)', [2, 1]))
+        self.assertEqual(FakeOrm.incr([1, 2], type=-1), 1)
+        self.assertEqual(self.conn.executed[-1][1], (-1, 1, 2))
+        self.assertRaises(SqlValueError, FakeOrm.incr, 1, title=1)
+        executed = len(self.conn.executed)
+        self.assertEqual(FakeOrm.incr([], type=1), 0)
+        self.assertEqual(FakeOrm.incr([], type=1, commit=False), ('', []))
+        self.assertEqual(len(self.conn.executed), executed)
+
+        buf = CounterBuffer(FakeOrm, interval=60, flush_at_exit=False)
+        buf.incr(1, type=1)
+        buf.incr(1, type=2, content=1)
+        buf.incr(2, type=1)
+        self.assertEqual(buf.pending(), {1: {'type': 3, 'content': 1}, 2: {'type': 1}})
+        self.conn.gone_away = 1
+        self.assertRaises(Exception, buf.flush)
+        self.assertEqual(buf.stats()['pending'], 3)
+        self.assertEqual(buf.flush(), 1)
+        sql, values = self.conn.executed[-1]
+        self.assertEqual(sql, 'UPDATE `test_orm` SET `content`=`content`+CASE `id` WHEN %s THEN %s ELSE 0 END,'
+                              '`type`=`type`+CASE `id` WHEN %s THEN %s WHEN %s THEN %s ELSE 0 END '
+                              'WHERE `id` IN (%s,%s)')
+        self.assertEqual(values, (1, 1, 1, 3, 2, 1, 1, 2))
+        buf.max_pending = 2
+        buf.incr(3, type=1)
+        buf.incr(4, type=1)
+        for i in range(100):
+            if not buf.pending():
+                break
+            time.sleep(0.01)
+        self.assertEqual(buf.pending(), {})
+        buf.incr(5, type=1)
+        buf.close()
+        self.assertEqual(self.conn.executed[-1][1], (5, 1, 5))
+        self.assertRaises(SqlValueError, buf.incr, 5, type=1)
+
+    def test_query_cache(self):
+        FakeOrm._query_cache = LRUCache(100)
+        try:
+            qs = FakeOrm.find(type=1, cache=True)
+            self.assertEqual(FakeOrm.find(type=1, cache=True)[0].name, 'test0')
+            self.assertFalse(qs[0] is FakeOrm.find(type=1, cache=True)[0])
+            self.assertEqual(len(self.conn.executed), 1)
+            rs = FakeOrm.find(fields=['id', 'name'], cache=True)
+            rs[0]['name'] = 'changed'
+            self.assertEqual(FakeOrm.find(fields=['id', 'name'], cache=True)[0]['name'], 'test0')
+            FakeOrm.number(cache=30)
+            FakeOrm.number(cache=30)
+            self.assertEqual(len(self.conn.executed), 3)
+            FakeOrm.cls_update(set_(name='x'), id=1)
+            FakeOrm.find(type=1, cache=True)
+            FakeOrm.find(type=1)
+            self.assertEqual(len(self.conn.executed), 6)
+            info = FakeOrm.query_cache_info()
+            stats = info[self.conn.executed[0][0]]
+            self.assertEqual((stats['hits'], stats['misses']), (2, 2))
+            self.assertEqual(stats['hit_ratio'], 0.5)
+
+            calls = []
+
+            def slow_query(sql, *values):
+                calls.append(sql)
+                time.sleep(0.1)
+                return [{'id': 2, 'name': 'slow'}]
+            self.conn.query = slow_query
+            threads = [threading.Thread(target=FakeOrm.find, kwargs={'type': 2, 'cache': True}) for i in range(5)]
+            for th in threads:
+                th.start()
+            for th in threads:
+                th.join()
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(FakeOrm.query_cache_info()[calls[0]]['coalesced'], 4)
+        finally:
+            FakeOrm._query_cache = None
+
+    def test_columnar(self):
+        now = datetime.datetime(2020, 1, 2, 3, 4, 5)
+        self.conn.rows = [{'id': i, 'name': 'n%s' % i, 'content': now, 'type': i if i % 2 else None}
+                          for i in range(5)]
+        cols = FakeOrm.find(fields=['id', 'name', 'content', 'type'], columnar=True)
+        self.assertEqual(sorted(cols), ['content', 'id', 'name', 'type'])
+        self.assertEqual(list(cols['id']), range(5))
+        self.assertEqual(list(cols['name']), ['n0', 'n1', 'n2', 'n3', 'n4'])
+        try:
+            import numpy
+            self.assertEqual(str(cols['id'].dtype), 'int64')
+            self.assertEqual(cols['content'].dtype, object)
+            self.assertEqual(numpy.isnan(cols['type']).sum(), 3)
+            # 时间列按需转为 datetime64
+            self.conn.rows[0]['content'] = None
+            cols = FakeOrm.find(fields=['id', 'content'], columnar='datetime64')
+            self.assertEqual(str(cols['content'].dtype), 'datetime64[us]')
+            self.assertEqual(cols['content'][1], numpy.datetime64(now))
+            self.assertTrue(numpy.isnat(cols['content'][0]))
+        except ImportError:
+            self.assertEqual(cols['id'].typecode, 'l')
+            self.assertEqual(cols['type'], [None, 1, None, 3, None])
+        batches = list(FakeOrm.find_iter(fields=['id', 'type'], batch_size=2, row_type='columns'))
+        self.assertEqual([list(b['id']) for b in batches], [[0, 1], [2, 3], [4]])
+        self.assertEqual(sorted(FakeOrm.all(columnar=True)), ['content', 'id', 'name', 'type'])
+
+    def test_parallel_scan(self):
+        self.assertRaises(SqlValueError, FakeOrm.parallel_scan)
+        rows = [{'id': i, 'name': 'n%s' % i} for i in range(1, 101)]
+        FakeOrm._db_conn = get_connection(host='localhost', database='test', creator=lambda: ScanConnection(rows))
+        try:
+            self.assertEqual(FakeOrm.scan_partitions(4), [(1, 25), (26, 50), (51, 75), (76, 100)])
+            # 按行数上限增加分区数
+            self.assertEqual(FakeOrm.scan_partitions(1, partition_rows=30), [(1, 25), (26, 50), (51, 75), (76, 100)])
+            chunks = list(FakeOrm.parallel_scan(workers=1, partition_rows=10))
+            self.assertEqual((len(chunks), max(len(c) for c in chunks)), (10, 10))
+            infos = []
+            ScanConnection.fail = [26]
+            chunks = list(FakeOrm.parallel_scan(partitions=4, workers=3, ordered=True, retries=1,
+                                                progress=infos.append))
+            self.assertEqual([o.id for chunk in chunks for o in chunk], range(1, 101))
+            self.assertEqual(sorted((d['partition'], d['rows'], d['attempts']) for d in infos),
+                             [(0, 25, 1), (1, 25, 2), (2, 25, 1), (3, 25, 1)])
+            chunks = list(FakeOrm.parallel_scan(partitions=3, row_type='dict', fields=['id']))
+            self.assertEqual(sorted(d['id'] for chunk in chunks for d in chunk), range(1, 101))
+            ScanConnection.fail = [1, 1]
+            self.assertRaises(Exception, list, FakeOrm.parallel_scan(partitions=2, retries=1))
+            # 同时提交的分区数有上限
+            executor = CountingExecutor(1)
+            stream = iter(FakeOrm.parallel_scan(partitions=10, executor=executor, ordered=True))
+            self.assertEqual([o.id for o in next(stream)], range(1, 11))
+            self.assertEqual(executor.submitted, 2)
+            self.assertEqual(len(list(stream)), 9)
+            self.assertEqual(executor.submitted, 10)
+            executor.shutdown()
+        finally:
+            ScanConnection.fail = []
+
+
 class OrmTest(unittest.TestCase):
 
     def setUp(self):
@@ -85,6 +906,25 @@ class OrmTest(unittest.TestCase):
         # print '***rs: ', rs
         self.assertEqual(len(rs), 5)
 
+    def test_bulk_insert(self):
+        data = (dict(name='test%s' % i, type=i % 2) if i % 3 else dict(name='test%s' % i) for i in range(25))
+        reports = []
+        rs = TestOrm.bulk_insert(data, chunk_size=10, report=reports.append, as_objects=True)
+        self.assertEqual([r['rows'] for r in rs], [10, 10, 5])
+        self.assertEqual(reports, rs)
+        first, last = rs[0]['ids']
+        self.assertEqual(last - first, 9)
+        self.assertEqual(rs[2]['objects'][-1].name, 'test24')
+        r = self.conn.get('select * from test_orm where name="test24"')
+        self.assertEqual(r.type, 1)
+        self.assertEqual(r.id, rs[2]['ids'][1])
+        rs = TestOrm.bulk_insert([dict(name='a' * 100)] * 5, max_bytes=250, commit=False)
+        self.assertEqual(len(rs), 3)
+        sql, values = TestOrm.bulk_insert([dict(id=1, name='test')], ignore=True, on_duplicate=['name'],
+                                          commit=False)[0]
+        self.assertTrue(sql.startswith('INSERT IGNORE INTO'))
+        self.assertTrue(sql.endswith('ON DUPLICATE KEY UPDATE `name`=VALUES(`name`)'))
+
     def test_page(self):
         # 插入十条数据
         for i in range(10):
@@ -141,6 +981,43 @@ class OrmTest(unittest.TestCase):
         r2 = self.conn.query('select * from test_orm where name="test2"')
         self.assertTrue(r2)
 
+    def test_seek(self):
+        for i in range(10):
+            self._init_data(_type=i % 3)
+        ids = []
+        rs, cursor = TestOrm.seek(order_by='type', per_page=4)
+        ids.extend(o.id for o in rs)
+        while cursor:
+            rs, cursor = TestOrm.seek(cursor=cursor, order_by='type', per_page=4)
+            ids.extend(o.id for o in rs)
+        self.assertEqual(len(ids), 10)
+        self.assertEqual(len(set(ids)), 10)
+        rs, cursor = TestOrm.seek(per_page=3, desc=True, fields=['name'])
+        self.assertEqual(len(rs), 3)
+        self.assertTrue(rs[0]['id'] > rs[1]['id'])
+
+    def test_stmt_cache(self):
+        self._init_data()
+        TestOrm._stmt_cache().clear()
+        info = TestOrm.stmt_cache_info()
+        TestOrm.get(name='test0')
+        o = TestOrm.get(name='test1')
+        self.assertFalse(o)
+        sql, values = TestOrm.page(page=3, per_page=6, commit=False)
+        self.assertEqual(values, [6, 12])
+        TestOrm.page(page=1, per_page=6)
+        new_info = TestOrm.stmt_cache_info()
+        self.assertEqual(new_info['misses'] - info['misses'], 2)
+        self.assertEqual(new_info['hits'] - info['hits'], 2)
+
+    def test_paginate(self):
+        for i in range(7):
+            self._init_data(_type=i % 2)
+        rs, total, has_next = TestOrm.paginate(1, per_page=3, count='cached', type=0)
+        self.assertEqual((len(rs), total, has_next), (3, 4, True))
+        rs, total, has_next = TestOrm.paginate(3, per_page=3, count='approx')
+        self.assertEqual((len(rs), total, has_next), (1, 7, False))
+
     def _empty_table(self):
         self.conn.execute("delete from test_orm")
 
@@ -3,26 +3,26 @@
 """ base ORM
 """
 
+import os
+import re
+import sys
+import time
+import types
+import json
+import array
+import atexit
+import base64
+import hashlib
 import logging
+import itertools
 import datetime
+import threading
+import contextlib
+from collections import OrderedDict, deque
 
 version = '2.0'
 
 
-# def get_connection(host, database, user=None, password=None, pre_exe=None, autocommit=True):
-#     """ 数据库连接
-#         pre_exe: 数据库准备执行语句, 列表方式罗列
-#     """
-#     con = Connection(host=host, database=database, user=user, password=password, time_zone='SYSTEM')
-#     if pre_exe:
-#         for sql in pre_exe:
-#             try:
-#                 con.execute(sql)
-#             except:
-#                 pass
-#     return con
-
-
 # _CONNS_ = {}
 #
 #
@@ -50,6 +50,16 @@ class SqlValueError(Exception):
     pass
 
 
+# 属性未设置的标记
+_MISSING = object()
+
+
+class TooManyConnections(Exception):
+    """ 连接池已满
+    """
+    pass
+
+
 # 比较运算 exam: age__gt = 34 //age 大于34
 _COMS = {'gt': '>',  # 大于
          'lt': '<',  # 小于
@@ -58,54 +68,165 @@ _COMS = {'gt': '>',  # 大于
          'no': '<>',  # 不等于
          'like': ' like ', }
 
+# 其他运算
+# id__in=[1, 2] // id IN (1, 2), 列表长度按2的幂补齐, 使语句形状可以复用
+# id__notin=[1, 2] // id NOT IN (1, 2)
+# age__between=(18, 30) // age BETWEEN 18 AND 30
+# name__isnull=True // name IS NULL, False 为 IS NOT NULL
+# name__startswith='ab' // name LIKE 'ab%', 可以使用索引
+_IN_OPS = {'in': ' IN (', 'notin': ' NOT IN ('}
 
-def _rebuild_argv(kwargs, args=None, rows=None, link=' and ', table=None):
-    """ 重构字典参数,以及连接成sql语句需要的字符串
-        args: (re_str, values)
-        kwargs: key, value dict
-        return where expr
+
+def _bucket(n):
+    """ IN 列表长度补齐到2的幂
     """
-    keys = kwargs.keys()
-    check_keys = [k.split('__')[0] for k in keys]
+    b = 1
+    while b < n:
+        b <<= 1
+    return b if n else 0
+
+
+def _escape_like(v):
+    return v.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _argv_shape(kwargs):
+    """ 参数形状, 用于缓存已编译的sql
+        return: ((key, n), ...) 按key排序, n为列表长度, 非列表为-1
+                __in/__notin 的 n 为补齐后的长度, __isnull 的 n 为 True/False
+        __in/__notin 的值为集合、生成器等时就地转为列表, 之后 _bind_argv 使用同一个列表; 不接受字符串
+    """
+    shape = []
+    for k, v in kwargs.items():
+        if '__' in k:
+            op = k.split('__')[1]
+            if op in _IN_OPS:
+                if isinstance(v, basestring):
+                    raise SqlValueError('%s needs a list of values, got %r' % (k, v))
+                if not isinstance(v, (list, tuple)):
+                    v = kwargs[k] = list(v)
+                shape.append((k, _bucket(len(v))))
+                continue
+            if op == 'isnull':
+                shape.append((k, bool(v)))
+                continue
+        shape.append((k, len(v) if isinstance(v, (list, tuple)) else -1))
+    shape.sort()
+    return tuple(shape)
+
+
+def _compile_argv(shape, args_str=None, rows=None, link=' and ', table=None):
+    """ 根据参数形状编译where表达式, 不涉及具体值
+        shape: _argv_shape 的返回值
+        args_str: and_/or_ 等返回的表达式字符串
+        return: (re_str, plan), plan 为值绑定计划 [(key, n, op), ...]
+    """
+    check_keys = [k.split('__')[0] for k, _ in shape]
     # 检测更新列是否都在表列中
     if rows and not set(check_keys).issubset(set(rows)):
         raise BuildArgsError(
             ''.join((str(check_keys), '<>', str(rows)))
         )
     _keys_str = []
-    _values = []
-    _list_args = []
-    for k, v in kwargs.items():
+    _plan = []
+    _list_str = []
+    _list_plan = []
+    for k, n in shape:
         com = '='
+        op = None
         sk = '`' + k + '`'
         if table:
             sk = table + '.' + sk
-        if isinstance(v, (list, tuple)):
-            # 构建or语句
-            if len(v) > 1:
-                _tk = (sk+'=%s', ) * len(v)
-                _list_args.append(('('+' or '.join(_tk)+')', v))
+        if '__' in k:
+            k1, k2 = k.split('__')
+            col = sk.replace(k, k1)
+            if k2 in _IN_OPS:
+                if not n:
+                    raise SqlValueError(k)
+                _plan.append((k, n, 'in'))
+                _keys_str.append(''.join((col, _IN_OPS[k2], ','.join(['%s'] * n), ')')))
                 continue
-            if not v:
-                raise SqlValueError
-            v = v[0]
+            if k2 == 'between':
+                if n != 2:
+                    raise SqlValueError(k)
+                _plan.append((k, n, 'between'))
+                _keys_str.append(col + ' BETWEEN %s AND %s')
+                continue
+            if k2 == 'isnull':
+                _keys_str.append(col + (' IS NULL' if n else ' IS NOT NULL'))
+                continue
+            if k2 == 'startswith':
+                # 只接受单个前缀
+                if n != -1:
+                    raise SqlValueError(k)
+                _plan.append((k, n, 'startswith'))
+                _keys_str.append(col + ' LIKE %s')
+                continue
+        if n > 1:
+            # 构建or语句
+            _tk = (sk+'=%s', ) * n
+            _list_str.append('('+' or '.join(_tk)+')')
+            _list_plan.append((k, n, None))
+            continue
+        if n == 0:
+            raise SqlValueError
         if '__' in k:
             k1, k2 = k.split('__')
             if k2 == 'like':
-                v = ''.join(('%', v, '%'))
+                op = 'like'
             com = _COMS.get(k2, '=')
             if com != '=':
                 sk = sk.replace(k, k1)
-        _values.append(v)
+        _plan.append((k, n, op))
         _keys_str.append(''.join((sk, com, '%s')))
-    if args:
-        _list_args.append(args)
-    for item in _list_args:
-        _keys_str.append(item[0])
-        _values.extend(item[1])
+    _keys_str.extend(_list_str)
+    _plan.extend(_list_plan)
+    if args_str is not None:
+        _keys_str.append(args_str)
     _keys_str = link.join(_keys_str)
-    _keys_str = ' (' + _keys_str + ') ' if kwargs else _keys_str
-    return _keys_str, _values
+    _keys_str = ' (' + _keys_str + ') ' if shape else _keys_str
+    return _keys_str, _plan
+
+
+def _bind_argv(plan, kwargs):
+    """ 按绑定计划取出参数值
+    """
+    _values = []
+    for k, n, op in plan:
+        v = kwargs[k]
+        if op == 'in':
+            _values.extend(v)
+            if len(v) < n:
+                _values.extend([v[-1]] * (n - len(v)))
+            continue
+        if op == 'between':
+            _values.extend(v)
+            continue
+        if n > 1:
+            _values.extend(v)
+            continue
+        if n == 1:
+            v = v[0]
+        if op == 'like':
+            v = ''.join(('%', v, '%'))
+        elif op == 'startswith':
+            v = _escape_like(v) + '%'
+        _values.append(v)
+    return _values
+
+
+def _rebuild_argv(kwargs, args=None, rows=None, link=' and ', table=None):
+    """ 重构字典参数,以及连接成sql语句需要的字符串
+        args: (re_str, values)
+        kwargs: key, value dict
+        return where expr
+    """
+    re_str, plan = _compile_argv(_argv_shape(kwargs), args[0] if args else None, rows=rows,
+                                 link=link, table=table)
+    values = _bind_argv(plan, kwargs)
+    if args:
+        values.extend(args[1])
+    return re_str, values
 
 
 def and_(args=None, **kwargs):
@@ -139,79 +260,2184 @@ def list_to_sql(l, table=''):
     return ','.join([table+'`'+str(i)+'`' for i in l])
 
 
-def join_(table, on_str, **kwargs):
-    """
-        join_(table='items', on_str='items.id=topic_item.item_id', status=1)
-    """
-    join_str = ' JOIN `' + table + '` on ' + on_str
-    re_str, values = _rebuild_argv(kwargs, table=table)
-    return join_str, re_str, values
+def join_(table, on_str, **kwargs):
+    """
+        join_(table='items', on_str='items.id=topic_item.item_id', status=1)
+    """
+    join_str = ' JOIN `' + table + '` on ' + on_str
+    re_str, values = _rebuild_argv(kwargs, table=table)
+    return join_str, re_str, values
+
+
+def _cursor_default(v):
+    if isinstance(v, (datetime.datetime, datetime.date)):
+        return str(v)
+    return unicode(v)
+
+
+# dumps_many 使用的编码器, 创建一次重复使用
+_json_encoder = json.JSONEncoder(separators=(',', ':'), default=_cursor_default)
+
+
+def encode_cursor(values):
+    """ 游标分页: 把排序列的值编码为不透明的游标字符串
+    """
+    return base64.urlsafe_b64encode(json.dumps(values, default=_cursor_default))
+
+
+def decode_cursor(cursor):
+    """ 游标分页: 解码游标字符串, 返回排序列的值列表
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise SqlValueError('bad cursor: %r' % cursor)
+    if not isinstance(values, list):
+        raise SqlValueError('bad cursor: %r' % cursor)
+    return values
+
+
+def _value_bytes(v):
+    """ 估算参数值在sql语句中占用的字节数
+    """
+    if v is None:
+        return 4
+    if isinstance(v, unicode):
+        return len(v.encode('utf-8')) + 3
+    if isinstance(v, str):
+        return len(v) + 3
+    return len(str(v)) + 1
+
+
+def _fields_key(fields):
+    """ 字段列表转为可哈希的缓存键
+    """
+    if isinstance(fields, (str, unicode)):
+        return fields
+    return tuple(fields)
+
+
+class CacheBackend(object):
+    """ 缓存后端接口, 外部缓存(memcached/redis等)按此接口实现即可用于行缓存
+        缓存的值为列名到列值的字典
+    """
+
+    def get(self, key, default=None):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        """ ttl: 过期秒数, None 使用后端的默认值
+        """
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def stats(self):
+        return {}
+
+
+class LRUCache(CacheBackend):
+    """ 线程安全的进程内LRU缓存, 支持过期时间, 记录命中/未命中/淘汰次数
+        ttl: 默认过期秒数, None 为不过期
+    """
+
+    def __init__(self, maxsize=256, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+        self._data = OrderedDict()  # key: (value, 过期时间)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expire = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expire is not None and expire < time.time():
+                self.expired += 1
+                self.misses += 1
+                return default
+            self._data[key] = (value, expire)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expire = time.time() + ttl if ttl else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expire)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'expired': self.expired,
+                'size': len(self._data), 'maxsize': self.maxsize}
+
+
+# ---------------- 语句监控 ---------------------
+
+# 语句监听函数, 每条语句执行后以 QueryEvent 为参数调用
+_listeners = []
+
+
+def add_listener(fn):
+    """ 注册语句监听函数, 没有监听函数时不产生任何额外开销
+    """
+    _listeners.append(fn)
+    return fn
+
+
+def remove_listener(fn):
+    if fn in _listeners:
+        _listeners.remove(fn)
+
+
+_FINGERPRINT_RES = (
+    (re.compile(r"'(?:[^'\\]|\\.)*'"), '?'),
+    (re.compile(r'"(?:[^"\\]|\\.)*"'), '?'),
+    (re.compile(r'\b\d+\b'), '?'),
+    (re.compile(r'\((?:\s*%s\s*,)+\s*%s\s*\)'), '(%s...)'),
+    (re.compile(r'(\S+=%s)(?: or \1)+'), r'\1 or ...'),
+    (re.compile(r'\s+'), ' '),
+)
+_fingerprints = LRUCache(1024)
+
+
+def fingerprint(sql):
+    """ 语句指纹: 去掉字面量, 合并 IN 列表和 or 列表, 同一形状的语句指纹相同
+    """
+    fp = _fingerprints.get(sql)
+    if fp is None:
+        fp = sql
+        for pattern, repl in _FINGERPRINT_RES:
+            fp = pattern.sub(repl, fp)
+        fp = _fingerprints.set(sql, fp.strip())
+    return fp
+
+
+class QueryEvent(object):
+    """ 一条语句的执行信息
+        model/method: 发起语句的模型和 Base 方法, call_site: 调用 tornorm 的代码位置 '文件:行号'
+        bind_time: sql生成耗时(编译缓存的语句), exec_time: 执行耗时, 单位秒
+        rows: 返回或影响的行数, 无法确定时为 None
+        conn_id: 执行语句的物理连接的 id(), 连接池时为借出的连接
+    """
+
+    __slots__ = ('sql', 'fingerprint', 'model', 'method', 'call_site', 'mode', 'bind_time', 'exec_time', 'rows',
+                 'conn_id', 'error')
+
+    def __init__(self, **kwargs):
+        for k in self.__slots__:
+            setattr(self, k, kwargs.get(k))
+
+    def __repr__(self):
+        return '<QueryEvent %s %.4fs %r>' % (self.method, self.exec_time, self.fingerprint)
+
+
+def _caller_info():
+    """ 沿调用栈找到发起语句的模型、方法和调用位置
+    """
+    f = sys._getframe(2)
+    model = method = None
+    while f is not None and f.f_globals.get('__name__') == __name__:
+        local = f.f_locals
+        owner = local.get('cls')
+        if owner is None and 'self' in local:
+            owner = type(local['self'])
+        if isinstance(owner, type) and issubclass(owner, Base):
+            model, method = owner, f.f_code.co_name
+        f = f.f_back
+    call_site = '%s:%s' % (f.f_code.co_filename, f.f_lineno) if f is not None else None
+    return model, method, call_site
+
+
+def _result_rows(mode, result):
+    if mode == 'query':
+        return len(result)
+    if mode == 'get':
+        return 1 if result else 0
+    if mode in ('execute_rowcount', 'executemany_rowcount'):
+        return result
+    return None
+
+
+def _emit(event):
+    for fn in list(_listeners):
+        try:
+            fn(event)
+        except Exception as ex:
+            logging.error('[HqOrm listener]: %r', ex)
+
+
+def _execute_observed(sql, values, db_con, mode):
+    model, method, call_site = _caller_info()
+    start = time.time()
+    bind_start = getattr(_session, 'bind_start', None)
+    _session.bind_start = None
+    _session.pool_con = None
+    error = None
+    result = None
+    try:
+        result = getattr(db_con, mode)(sql, *values)
+        return result
+    except Exception as ex:
+        error = ex
+        raise
+    finally:
+        # 连接池执行时记录实际借出的连接
+        con = _session.pool_con if isinstance(db_con, ConnectionPool) else db_con
+        _emit(QueryEvent(sql=sql, fingerprint=fingerprint(sql), model=model, method=method, call_site=call_site,
+                         mode=mode, bind_time=start - bind_start if bind_start else 0.0,
+                         exec_time=time.time() - start, rows=None if error else _result_rows(mode, result),
+                         conn_id=id(con) if con is not None else None, error=error))
+
+
+class QueryStats(object):
+    """ 按语句指纹汇总的内存统计, 作为监听函数使用
+        stats = add_listener(QueryStats())
+        stats.report()  # [{'fingerprint', 'count', 'errors', 'rows', 'total', 'p50', 'p95', 'p99'}, ...]
+        samples: 每个指纹保留最近的耗时样本数, 用于计算分位数
+    """
+
+    def __init__(self, samples=1000):
+        self.samples = samples
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def __call__(self, event):
+        with self._lock:
+            st = self._data.get(event.fingerprint)
+            if st is None:
+                st = self._data[event.fingerprint] = {'count': 0, 'errors': 0, 'rows': 0, 'total': 0.0,
+                                                      'times': deque(maxlen=self.samples)}
+            st['count'] += 1
+            st['total'] += event.exec_time
+            st['times'].append(event.exec_time)
+            if event.error is not None:
+                st['errors'] += 1
+            if event.rows:
+                st['rows'] += event.rows
+
+    @staticmethod
+    def _percentile(times, p):
+        return times[int(p * (len(times) - 1))] if times else 0.0
+
+    def report(self):
+        """ 按总耗时倒序返回各指纹的统计
+        """
+        with self._lock:
+            items = [(fp, dict(st, times=sorted(st['times']))) for fp, st in self._data.items()]
+        result = []
+        for fp, st in items:
+            times = st.pop('times')
+            st.update(fingerprint=fp, p50=self._percentile(times, 0.5), p95=self._percentile(times, 0.95),
+                      p99=self._percentile(times, 0.99))
+            result.append(st)
+        result.sort(key=lambda st: st['total'], reverse=True)
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+def add_slow_query_hook(threshold, callback):
+    """ 执行耗时超过 threshold 秒的语句以 QueryEvent 为参数调用 callback
+        return: 监听函数, 可用 remove_listener 移除
+    """
+    def listener(event):
+        if event.exec_time >= threshold:
+            callback(event)
+    return add_listener(listener)
+
+
+def _execute_sql(sql, values, db_con, mode='execute', echo=False):
+    """ 连接到数据库执行sql语句, mode: execute/get/query
+    """
+    if echo:
+        logging.info('[HqOrm Gen-SQL]: %s %r', sql, values)
+    if _listeners:
+        return _execute_observed(sql, values, db_con, mode)
+    return getattr(db_con, mode)(sql, *values)
+
+
+# ---------------- 连接池 ---------------------
+
+# 连接已断开的mysql错误码: 2006 server has gone away, 2013 lost connection, 2055 lost connection
+_DISCONNECT_CODES = (2006, 2013, 2055)
+
+
+def _is_disconnect(ex):
+    """ 判断异常是否为连接断开
+    """
+    args = getattr(ex, 'args', None)
+    return bool(args) and args[0] in _DISCONNECT_CODES
+
+
+def _torndb_creator(host, database, user=None, password=None, **kwargs):
+    """ 默认的物理连接构造函数
+        空闲重连由连接池负责, 以保证 pre_exe 在每个物理连接上都执行
+    """
+    from torndb import Connection
+    kwargs.setdefault('time_zone', 'SYSTEM')
+    kwargs['max_idle_time'] = float('inf')
+
+    def create():
+        return Connection(host=host, database=database, user=user, password=password, **kwargs)
+    return create
+
+
+class ConnectionPool(object):
+    """ 线程安全的数据库连接池, 对外接口与 torndb.Connection 一致, 每条语句单独借还连接
+        creator: 无参函数, 返回一个新的物理连接
+        pre_exe: 每个物理连接建立(或重连)后执行一次的语句列表
+        mincached: 启动时创建并至少保留的空闲连接数
+        maxcached: 最多保留的空闲连接数, 多余的连接归还时关闭
+        maxconnections: 最大连接数, 0 为不限制
+        blocking: 连接数已满时是否等待, 否则抛出 TooManyConnections
+        timeout: 等待连接的最长秒数, None 为一直等待
+        max_idle_time: 空闲超过该秒数的连接被回收
+        ping_interval: 空闲超过该秒数的连接借出前做一次健康检查
+    """
+
+    def __init__(self, creator, pre_exe=None, mincached=0, maxcached=10, maxconnections=0, blocking=True,
+                 timeout=None, max_idle_time=3600, ping_interval=30):
+        self._creator = creator
+        self._pre_exe = pre_exe or ()
+        self.mincached = mincached
+        self.maxcached = max(maxcached, mincached)
+        self.maxconnections = maxconnections
+        self.blocking = blocking
+        self.timeout = timeout
+        self.max_idle_time = max_idle_time
+        self.ping_interval = ping_interval
+        self._cond = threading.Condition()
+        self._idle = []  # [(con, last_use_time)], 末尾为最近使用
+        self._size = 0  # 已建立的物理连接数
+        self._closed = False
+        self._stats = {'checkouts': 0, 'created': 0, 'reconnects': 0, 'reaped': 0, 'waits': 0,
+                       'wait_time': 0.0, 'wait_max': 0.0, 'checkout_time': 0.0, 'checkout_max': 0.0}
+        for i in range(mincached):
+            self._size += 1
+            self._idle.append((self._connect(), time.time()))
+
+    def _prepare(self, con):
+        for sql in self._pre_exe:
+            try:
+                con.execute(sql)
+            except Exception as ex:
+                logging.warning('[HqOrm pre_exe]: %s %r', sql, ex)
+
+    def _connect(self):
+        con = self._creator()
+        self._prepare(con)
+        with self._cond:
+            self._stats['created'] += 1
+        return con
+
+    def _reconnect(self, con):
+        con.reconnect()
+        self._prepare(con)
+        with self._cond:
+            self._stats['reconnects'] += 1
+
+    @staticmethod
+    def _close(con):
+        try:
+            con.close()
+        except Exception:
+            pass
+
+    def _ping(self, con):
+        """ 健康检查, 失败时重连
+        """
+        try:
+            if hasattr(con, 'ping'):
+                con.ping()
+            elif getattr(con, '_db', None) is not None:
+                con._db.ping()
+            else:
+                raise Exception('not connected')
+        except Exception:
+            self._reconnect(con)
+
+    def _reap(self, now):
+        """ 回收空闲过久的连接, 保留 mincached 个, 需持有锁
+        """
+        while len(self._idle) > self.mincached and now - self._idle[0][1] > self.max_idle_time:
+            con, _ = self._idle.pop(0)
+            self._size -= 1
+            self._stats['reaped'] += 1
+            self._close(con)
+
+    def checkout(self):
+        """ 借出一个连接, 用完必须调用 checkin 归还
+        """
+        start = time.time()
+        con = last_use = None
+        with self._cond:
+            if self._closed:
+                raise TooManyConnections('pool closed')
+            while True:
+                self._reap(time.time())
+                if self._idle:
+                    con, last_use = self._idle.pop()
+                    break
+                if not self.maxconnections or self._size < self.maxconnections:
+                    self._size += 1
+                    break
+                if not self.blocking:
+                    raise TooManyConnections(self.maxconnections)
+                remaining = None
+                if self.timeout is not None:
+                    remaining = self.timeout - (time.time() - start)
+                    if remaining <= 0:
+                        raise TooManyConnections(self.maxconnections)
+                self._cond.wait(remaining)
+            waited = time.time() - start
+        try:
+            if con is None:
+                con = self._connect()
+            elif self.ping_interval is not None and time.time() - last_use > self.ping_interval:
+                self._ping(con)
+        except Exception:
+            self._discard(con)
+            raise
+        latency = time.time() - start
+        with self._cond:
+            st = self._stats
+            st['checkouts'] += 1
+            if waited > 0.001:
+                st['waits'] += 1
+            st['wait_time'] += waited
+            st['wait_max'] = max(st['wait_max'], waited)
+            st['checkout_time'] += latency
+            st['checkout_max'] = max(st['checkout_max'], latency)
+        return con
+
+    def checkin(self, con):
+        """ 归还连接
+        """
+        with self._cond:
+            if self._closed or len(self._idle) >= self.maxcached:
+                self._size -= 1
+                self._close(con)
+            else:
+                self._idle.append((con, time.time()))
+            self._cond.notify()
+
+    def _discard(self, con):
+        """ 丢弃一个损坏的连接
+        """
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+        if con is not None:
+            self._close(con)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """ 借出一个连接在 with 块内独占使用
+            with pool.connection() as con: ...
+        """
+        con = self.checkout()
+        broken = False
+        try:
+            yield con
+        except Exception as ex:
+            broken = _is_disconnect(ex)
+            raise
+        finally:
+            if broken:
+                self._discard(con)
+            else:
+                self.checkin(con)
+
+    def _run(self, mode, query, parameters, kwparameters):
+        con = self.checkout()
+        _session.pool_con = con  # 供监控事件记录物理连接
+        try:
+            try:
+                result = getattr(con, mode)(query, *parameters, **kwparameters)
+            except Exception as ex:
+                if not _is_disconnect(ex):
+                    raise
+                # 连接断开, 重连后只对 gone away 重试一次(语句未送达服务端)
+                self._reconnect(con)
+                if ex.args[0] != 2006:
+                    raise
+                result = getattr(con, mode)(query, *parameters, **kwparameters)
+        except Exception as ex:
+            if _is_disconnect(ex):
+                self._discard(con)
+            else:
+                self.checkin(con)
+            raise
+        self.checkin(con)
+        return result
+
+    def query(self, query, *parameters, **kwparameters):
+        return self._run('query', query, parameters, kwparameters)
+
+    def get(self, query, *parameters, **kwparameters):
+        return self._run('get', query, parameters, kwparameters)
+
+    def execute(self, query, *parameters, **kwparameters):
+        return self._run('execute', query, parameters, kwparameters)
+
+    def execute_lastrowid(self, query, *parameters, **kwparameters):
+        return self._run('execute_lastrowid', query, parameters, kwparameters)
+
+    def execute_rowcount(self, query, *parameters, **kwparameters):
+        return self._run('execute_rowcount', query, parameters, kwparameters)
+
+    def executemany(self, query, parameters):
+        return self._run('executemany', query, (parameters, ), {})
+
+    def executemany_rowcount(self, query, parameters):
+        return self._run('executemany_rowcount', query, (parameters, ), {})
+
+    def iter(self, query, *parameters, **kwparameters):
+        """ 迭代结果, 迭代结束或生成器关闭时归还连接
+        """
+        with self.connection() as con:
+            rows = con.iter(query, *parameters, **kwparameters)
+            try:
+                for row in rows:
+                    yield row
+            finally:
+                if hasattr(rows, 'close'):
+                    rows.close()
+
+    def close(self):
+        """ 关闭所有空闲连接, 借出的连接在归还时关闭
+        """
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for con, _ in idle:
+            self._close(con)
+
+    def stats(self):
+        """ 连接池统计: 连接数, 借出次数, 等待时间, 借出耗时等(秒)
+        """
+        with self._cond:
+            st = dict(self._stats)
+            st['size'] = self._size
+            st['idle'] = len(self._idle)
+            st['in_use'] = self._size - len(self._idle)
+        n = st['checkouts'] or 1
+        st['wait_avg'] = st['wait_time'] / n
+        st['checkout_avg'] = st['checkout_time'] / n
+        return st
+
+
+def get_connection(host, database, user=None, password=None, pre_exe=None, mincached=0, maxcached=10,
+                   maxconnections=0, blocking=True, timeout=None, max_idle_time=3600, ping_interval=30,
+                   creator=None, **kwargs):
+    """ 数据库连接池, 可直接作为模型的 _db_conn
+        pre_exe: 数据库准备执行语句, 列表方式罗列, 每个物理连接执行一次
+        creator: 自定义物理连接构造函数, 默认使用 torndb.Connection
+        其余参数见 ConnectionPool, kwargs 传给 torndb.Connection
+    """
+    creator = creator or _torndb_creator(host, database, user=user, password=password, **kwargs)
+    return ConnectionPool(creator, pre_exe=pre_exe, mincached=mincached, maxcached=maxcached,
+                          maxconnections=maxconnections, blocking=blocking, timeout=timeout,
+                          max_idle_time=max_idle_time, ping_interval=ping_interval)
+
+
+# ---------------- 读写分离 ---------------------
+
+# 当前线程的会话状态: 进行中的事务, 各模型最近一次写操作的时间
+_session = threading.local()
+
+
+def _in_transaction():
+    return bool(getattr(_session, 'txs', None))
+
+
+def _last_writes():
+    writes = getattr(_session, 'writes', None)
+    if writes is None:
+        writes = _session.writes = {}
+    return writes
+
+
+def show_slave_lag(con):
+    """ 默认的从库延迟检查, 返回 Seconds_Behind_Master, 复制中断时返回无穷大
+    """
+    row = con.get('SHOW SLAVE STATUS')
+    if not row:
+        return 0
+    lag = row.get('Seconds_Behind_Master')
+    return float('inf') if lag is None else lag
+
+
+class ReplicaSet(object):
+    """ 从库集合, 为读操作选择从库
+        replicas: 从库连接(或连接池)列表
+        strategy: 'round_robin' 轮询, 'least_latency' 选择平均耗时最小的从库
+        max_lag: 允许的最大复制延迟秒数, 超过时不使用该从库, None 为不检查
+        lag_interval: 复制延迟的检查间隔秒数
+        lag_fn: 延迟检查函数, 参数为连接, 默认为 show_slave_lag
+        down_time: 从库出错后暂停使用的秒数
+        所有从库都不可用时, 读操作回退到主库
+    """
+
+    def __init__(self, replicas, strategy='round_robin', max_lag=None, lag_interval=5, lag_fn=None, down_time=30):
+        if strategy not in ('round_robin', 'least_latency'):
+            raise ValueError(strategy)
+        self.replicas = list(replicas)
+        self.strategy = strategy
+        self.max_lag = max_lag
+        self.lag_interval = lag_interval
+        self.lag_fn = lag_fn or show_slave_lag
+        self.down_time = down_time
+        self._lock = threading.Lock()
+        self._next = 0
+        self._stats = [{'reads': 0, 'errors': 0, 'latency': 0.0, 'lag': 0, 'lag_checked': 0, 'down_until': 0}
+                       for r in self.replicas]
+        self.fallbacks = 0  # 回退到主库的次数
+
+    def _usable(self, i, now):
+        st = self._stats[i]
+        if st['down_until'] > now:
+            return False
+        if self.max_lag is None:
+            return True
+        if now - st['lag_checked'] > self.lag_interval:
+            st['lag_checked'] = now
+            try:
+                st['lag'] = self.lag_fn(self.replicas[i])
+            except Exception as ex:
+                logging.warning('[HqOrm replica]: lag check failed %r', ex)
+                self.mark_down(i)
+                return False
+        return st['lag'] <= self.max_lag
+
+    def choose(self):
+        """ 返回选中从库的序号, 没有可用的从库时返回 None
+        """
+        now = time.time()
+        candidates = [i for i in range(len(self.replicas)) if self._usable(i, now)]
+        if not candidates:
+            with self._lock:
+                self.fallbacks += 1
+            return None
+        if self.strategy == 'least_latency':
+            return min(candidates, key=lambda i: self._stats[i]['latency'])
+        with self._lock:
+            self._next = (self._next + 1) % len(candidates)
+            return candidates[self._next]
+
+    def mark_down(self, i):
+        with self._lock:
+            self._stats[i]['errors'] += 1
+            self._stats[i]['down_until'] = time.time() + self.down_time
+
+    def execute(self, i, sql, values, mode, echo=False):
+        """ 在序号为 i 的从库上执行, 记录耗时(指数移动平均)
+        """
+        start = time.time()
+        result = _execute_sql(sql, values, db_con=self.replicas[i], mode=mode, echo=echo)
+        cost = time.time() - start
+        with self._lock:
+            st = self._stats[i]
+            st['reads'] += 1
+            st['latency'] = cost if st['reads'] == 1 else st['latency'] * 0.8 + cost * 0.2
+        return result
+
+    def stats(self):
+        return {'fallbacks': self.fallbacks, 'replicas': [dict(st) for st in self._stats]}
+
+
+# ---------------- 事务 ---------------------
+
+def _active_txs():
+    """ 当前线程进行中的最外层事务 {id(连接来源): Transaction}
+    """
+    txs = getattr(_session, 'txs', None)
+    if txs is None:
+        txs = _session.txs = {}
+    return txs
+
+
+def _pinned_conn(source):
+    """ 当前线程在 source 上有进行中的事务时, 返回事务独占的连接
+    """
+    txs = getattr(_session, 'txs', None)
+    if txs:
+        tx = txs.get(id(source))
+        if tx is not None:
+            tx.flush()
+            return tx.con
+    return source
+
+
+_WRITE_TABLE_RE = re.compile(r'^\s*(?:INSERT\s+(?:IGNORE\s+)?INTO|REPLACE\s+INTO|UPDATE|DELETE\s+FROM)\s+`?(\w+)`?', re.I)
+
+
+def _write_model(sql, default=None):
+    """ 按写语句中的表名查找模型, 多个模型使用同一张表时优先 default, 找不到时返回 None
+    """
+    m = _WRITE_TABLE_RE.match(sql)
+    if m is None:
+        return None
+    if default is not None and default._table_name == m.group(1):
+        return default
+    for model in _models.values():
+        if model._table_name == m.group(1):
+            return model
+    return None
+
+
+class Transaction(object):
+    """ 事务, with 块内的语句都在同一个连接上执行, 正常退出时提交, 出现异常时回滚
+        嵌套使用时内层为保存点
+        with Question.transaction() as tx:
+            q = Question.new(title=title)
+            tx.add(Answer.new(commit=False, question_id=q.id))  # 排队, 与其他排队语句合并为一次执行
+    """
+
+    def __init__(self, model, batch=True):
+        self.model = model
+        self.batch = batch  # 排队的语句是否合并为一条多语句执行
+        source = model._db_conn
+        self.source = source if source is not None else model.get_conn()
+        self.con = None
+        self.parent = None
+        self.savepoint = None
+        self.queue = []  # 排队的 (sql, values, 模型)
+        self.writes = []  # 事务结束后需要重新失效缓存的 (模型, 行)
+        self._savepoints = 0
+        self._mark = 0
+
+    def _raw_execute(self, sql, values=(), mode='execute'):
+        return _execute_sql(sql, list(values), db_con=self.con, mode=mode, echo=self.model._echo)
+
+    def __enter__(self):
+        txs = _active_txs()
+        parent = txs.get(id(self.source))
+        if parent is not None:
+            parent.flush()
+            parent._savepoints += 1
+            self.parent = parent
+            self.con = parent.con
+            self.savepoint = 'tornorm_sp_%d' % parent._savepoints
+            self._mark = len(parent.queue)
+            self._raw_execute('SAVEPOINT ' + self.savepoint)
+            return self
+        self.con = self.source.checkout() if isinstance(self.source, ConnectionPool) else self.source
+        try:
+            self._raw_execute('BEGIN')
+        except Exception:
+            self._release(broken=True)
+            raise
+        txs[id(self.source)] = self
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback(broken=_is_disconnect(exc))
+        return False
+
+    @property
+    def root(self):
+        return self.parent or self
+
+    def add(self, stmt, values=None, model=None):
+        """ 排队一条语句, 在事务中下一条语句执行前或提交时执行
+            stmt: commit=False 返回的 (sql, values), 或 sql 字符串(此时需给出 values)
+            model: 语句所写的模型, 执行后使其缓存失效; 不给出时按 sql 中的表名查找
+        """
+        if values is not None:
+            stmt = (stmt, values)
+        if model is None:
+            model = _write_model(stmt[0], self.model)
+        self.root.queue.append((stmt[0], list(stmt[1]), model or self.model))
+
+    def flush(self):
+        """ 执行排队的语句, batch 为真时合并为一次执行
+        """
+        root = self.root
+        queue, root.queue = root.queue, []
+        if not queue:
+            return
+        if root.batch and len(queue) > 1:
+            values = []
+            for sql, vs, _ in queue:
+                values.extend(vs)
+            self._raw_execute(';'.join(sql.rstrip().rstrip(';') for sql, _, _ in queue), values)
+        else:
+            for sql, vs, _ in queue:
+                self._raw_execute(sql, vs)
+        # 排队的语句无法确定影响的行, 各模型整体失效
+        models = []
+        for _, _, model in queue:
+            if model not in models:
+                models.append(model)
+                model._on_write()
+
+    def execute(self, sql, values=(), mode='execute'):
+        """ 在事务连接上执行一条语句
+        """
+        self.flush()
+        return self._raw_execute(sql, values, mode)
+
+    def commit(self):
+        if self.parent is not None:
+            try:
+                self.flush()
+                self._raw_execute('RELEASE SAVEPOINT ' + self.savepoint)
+            except Exception as ex:
+                self.rollback(broken=_is_disconnect(ex))
+                raise
+            return
+        try:
+            self.flush()
+            self._raw_execute('COMMIT')
+        except Exception as ex:
+            self.rollback(broken=_is_disconnect(ex))
+            raise
+        self._finish()
+
+    def rollback(self, broken=False):
+        if self.parent is not None:
+            del self.parent.queue[self._mark:]
+            if not broken:
+                self._raw_execute('ROLLBACK TO SAVEPOINT ' + self.savepoint)
+            return
+        self.queue = []
+        try:
+            if not broken:
+                self._raw_execute('ROLLBACK')
+        finally:
+            self._finish(broken)
+
+    def _finish(self, broken=False):
+        _active_txs().pop(id(self.source), None)
+        self._release(broken)
+        # 事务中失效过的缓存可能又被事务外读到的旧值填充, 结束后再失效一次
+        writes, self.writes = self.writes, []
+        for model, rows in writes:
+            model._on_write(rows)
+
+    def _release(self, broken=False):
+        if isinstance(self.source, ConnectionPool):
+            if broken:
+                self.source._discard(self.con)
+            else:
+                self.source.checkin(self.con)
+
+
+# ---------------- 异步执行 ---------------------
+
+# 没有非阻塞驱动时, 异步方法在该线程池中执行sql
+ASYNC_WORKERS = 10
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _default_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                _executor = ThreadPoolExecutor(ASYNC_WORKERS)
+    return _executor
+
+
+def _new_future():
+    from concurrent.futures import Future
+    return Future()
+
+
+def _copy_future(src, dst):
+    """ 把 src 的结果或异常复制到 dst
+    """
+    try:
+        dst.set_result(src.result())
+    except Exception as ex:
+        dst.set_exception(ex)
+
+
+def _chain_future(future, fn):
+    """ future 完成后以其结果调用 fn, 返回新的 Future
+        fn 返回 Future 时, 新 Future 跟随其结果
+    """
+    out = _new_future()
+
+    def done(f):
+        try:
+            result = fn(f.result())
+        except Exception as ex:
+            out.set_exception(ex)
+            return
+        if hasattr(result, 'add_done_callback'):
+            result.add_done_callback(lambda r: _copy_future(r, out))
+        else:
+            out.set_result(result)
+    future.add_done_callback(done)
+    return out
+
+
+def _aexecute_sql(sql, values, db_con, mode='execute', echo=False, executor=None):
+    """ 异步执行sql, 返回 Future
+        连接的 is_async 属性为真时视为非阻塞驱动, 直接调用并返回其 Future; 否则提交到线程池执行
+        torndb 连接不是线程安全的, 线程池中执行时连接必须是 ConnectionPool, 每条语句单独借还连接
+    """
+    if getattr(db_con, 'is_async', False):
+        if echo:
+            logging.info('[HqOrm Gen-SQL]: %s %r', sql, values)
+        return getattr(db_con, mode)(sql, *values)
+    if not isinstance(db_con, ConnectionPool):
+        raise SqlValueError('async sql in threads needs a ConnectionPool or an async driver, got %r' % db_con)
+    executor = executor or _default_executor()
+    return executor.submit(_execute_sql, sql, values, db_con, mode, echo)
+
+
+# ---------------- 流式读取 ---------------------
+
+def _row_class():
+    """ 字典行使用 torndb.Row(支持属性访问), 没有 torndb 时使用 dict
+    """
+    try:
+        from torndb import Row
+    except ImportError:
+        Row = dict
+    return Row
+
+
+def _stream_batches(db_con, sql, values, batch_size, echo=False, types=None):
+    """ 使用服务端游标(SSCursor)分批读取, 每批生成 (列名列表, 元组行列表)
+        连接池借出的连接在迭代结束后归还; 中途关闭时直接丢弃该连接, 不必读完剩余结果
+        不是 torndb 连接时(如替身连接), 使用其 iter 方法
+        types: 传入列表时填充游标描述中的列类型(MySQLdb FIELD_TYPE), 替身连接没有列类型
+    """
+    if echo:
+        logging.info('[HqOrm Gen-SQL]: %s %r', sql, values)
+    observed = bool(_listeners)
+    if observed:
+        model, method, call_site = _caller_info()
+        start = time.time()
+        count = 0
+    pool = db_con if isinstance(db_con, ConnectionPool) else None
+    con = pool.checkout() if pool else db_con
+    finished = False
+    cursor = None
+    error = None
+    try:
+        if hasattr(con, '_ensure_connected'):
+            import MySQLdb.cursors
+            con._ensure_connected()
+            cursor = MySQLdb.cursors.SSCursor(con._db)
+            cursor.execute(sql, values)
+            names = [d[0] for d in cursor.description]
+            if types is not None:
+                types[:] = [d[1] for d in cursor.description]
+            while True:
+                batch = cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                if observed:
+                    count += len(batch)
+                yield names, batch
+        else:
+            rows = con.iter(sql, *values)
+            names = None
+            batch = []
+            for row in rows:
+                if names is None:
+                    names = list(row.keys())
+                batch.append(tuple([row[k] for k in names]))
+                if len(batch) >= batch_size:
+                    if observed:
+                        count += len(batch)
+                    yield names, batch
+                    batch = []
+            if batch:
+                if observed:
+                    count += len(batch)
+                yield names, batch
+        finished = True
+    except Exception as ex:
+        error = ex
+        raise
+    finally:
+        if observed:
+            _emit(QueryEvent(sql=sql, fingerprint=fingerprint(sql), model=model, method=method, call_site=call_site,
+                             mode='iter', bind_time=0.0, exec_time=time.time() - start, rows=count,
+                             conn_id=id(con), error=error))
+        if finished or not pool:
+            if cursor is not None:
+                cursor.close()
+            if pool:
+                pool.checkin(con)
+        else:
+            pool._discard(con)
+
+
+# ---------------- 列式读取 ---------------------
+
+# 列式读取每次从服务端读取的行数
+_COLUMN_BATCH = 10000
+
+# MySQLdb FIELD_TYPE 对应的列类型, 其他类型(字符串、DECIMAL等)为 'object'
+_FIELD_KINDS = {
+    1: 'int', 2: 'int', 3: 'int', 8: 'int', 9: 'int', 13: 'int',
+    4: 'float', 5: 'float',
+    7: 'datetime', 12: 'datetime',
+    10: 'date', 14: 'date',
+}
+_NUMPY_DTYPES = {'int': 'int64', 'float': 'float64', 'datetime': object, 'date': object, 'object': object}
+# columnar='datetime64' 时时间列的类型
+_DATETIME64_DTYPES = dict(_NUMPY_DTYPES, datetime='datetime64[us]', date='datetime64[D]')
+_ARRAY_CODES = {'int': 'l', 'float': 'd'}
+_EPOCH = datetime.datetime(1970, 1, 1)
+_EPOCH_DAY = _EPOCH.toordinal()
+_NAT = -2 ** 63  # numpy NaT 的 int64 表示
+
+
+def _numpy():
+    """ 已安装时返回 numpy 模块, 否则返回 None
+    """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def _epoch_offsets(col, kind):
+    """ 时间列转为相对 1970-01-01 的偏移(datetime 为微秒, date 为天), NULL 为 NaT
+        一次遍历得到整数列表, 再按 datetime64 解释, 比对象数组 astype 快
+    """
+    if kind == 'date':
+        return [v.toordinal() - _EPOCH_DAY if v is not None else _NAT for v in col]
+    out = []
+    for v in col:
+        if v is None:
+            out.append(_NAT)
+            continue
+        d = v - _EPOCH
+        out.append((d.days * 86400 + d.seconds) * 1000000 + d.microseconds)
+    return out
+
+
+def _value_kind(v):
+    """ 没有游标描述时按值推断列类型, None 无法推断
+    """
+    if v is None:
+        return None
+    if isinstance(v, (int, long)):
+        return 'int'
+    if isinstance(v, float):
+        return 'float'
+    if isinstance(v, datetime.datetime):
+        return 'datetime'
+    if isinstance(v, datetime.date):
+        return 'date'
+    return 'object'
+
+
+class _ColumnBuilder(object):
+    """ 把 (列名, 元组行) 批次按列转换为类型化的缓冲区, 不创建每行的字典
+        有 numpy 时每列为 ndarray, 否则整数/浮点列为 array.array, 其他列为 list
+        整数列出现 NULL 时: numpy 转为 float64(NULL 为 nan), 否则转为 list
+        时间列默认为对象数组; datetime64 为真且有 numpy 时转为 datetime64, NULL 为 NaT
+        types: _stream_batches 填充的游标列类型, 为空时按值推断
+    """
+
+    def __init__(self, types=None, np=_MISSING, datetime64=False):
+        self.np = _numpy() if np is _MISSING else np
+        self.dtypes = _DATETIME64_DTYPES if datetime64 else _NUMPY_DTYPES
+        self.types = types
+        self.names = None
+        self.kinds = None
+        self.chunks = None
+
+    def add(self, names, batch):
+        if self.names is None:
+            self.names = list(names)
+            if self.types:
+                self.kinds = [_FIELD_KINDS.get(t, 'object') for t in self.types]
+            else:
+                self.kinds = [None] * len(names)
+            self.chunks = [[] for _ in names]
+        for i, col in enumerate(zip(*batch)):
+            self.chunks[i].append(self._convert(i, col))
+
+    def _convert(self, i, col):
+        kind = self.kinds[i]
+        if kind is None:
+            kind = _value_kind(next((v for v in col if v is not None), None))
+            if kind is None:
+                # 全为 NULL, 确定类型后再转换
+                return col
+            self.kinds[i] = kind
+        np = self.np
+        if np is not None:
+            if kind == 'int':
+                try:
+                    return np.array(col, dtype='int64')
+                except (TypeError, ValueError, OverflowError):
+                    self.kinds[i] = kind = 'float'
+            dtype = self.dtypes[kind]
+            if dtype is not object and kind in ('datetime', 'date'):
+                try:
+                    return np.array(_epoch_offsets(col, kind), dtype='int64').view(dtype)
+                except (TypeError, AttributeError):
+                    # 零值日期等无法转换的值, 保留为对象
+                    self.kinds[i] = kind = 'object'
+                    dtype = object
+            return np.array(col, dtype=dtype)
+        code = _ARRAY_CODES.get(kind)
+        if code is not None:
+            try:
+                return array.array(code, col)
+            except (TypeError, OverflowError):
+                self.kinds[i] = 'object'
+        return list(col)
+
+    def _join(self, i):
+        kind = self.kinds[i] or 'object'
+        chunks = self.chunks[i]
+        # 类型确定前全为 NULL 的批次
+        has_null = any(isinstance(c, tuple) for c in chunks)
+        np = self.np
+        if np is not None:
+            if kind == 'int' and has_null:
+                kind = 'float'
+            dtype = self.dtypes[kind]
+            if not chunks:
+                return np.array([], dtype=dtype)
+            return np.concatenate([np.asarray(c, dtype=dtype) for c in chunks])
+        code = _ARRAY_CODES.get(kind)
+        if code is not None and not has_null:
+            result = array.array(code)
+            for c in chunks:
+                result.extend(c)
+            return result
+        result = []
+        for c in chunks:
+            result.extend(c)
+        return result
+
+    def result(self):
+        """ return: OrderedDict {列名: 数组}
+        """
+        if self.names is None:
+            return OrderedDict()
+        return OrderedDict((name, self._join(i)) for i, name in enumerate(self.names))
+
+
+class RowStream(object):
+    """ 流式结果集, 迭代结束、调用 close()、离开 with 块或被回收时释放连接
+        with Question.find_iter(status=1, row_type='model') as rows:
+            for q in rows: ...
+    """
+
+    def __init__(self, gen):
+        self._gen = gen
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return next(self._gen)
+
+    __next__ = next
+
+    def close(self):
+        self._gen.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+
+# ---------------- N+1 检测 ---------------------
+
+class NPlusOneDetector(object):
+    """ 统计当前线程中相同指纹语句的执行次数, 达到 threshold 时记录日志并调用 callback(event, count)
+        由 detect_n_plus_one 创建, 也负责 auto_batch 模式下延迟的 get 合并查询
+    """
+
+    def __init__(self, threshold=5, callback=None):
+        self.threshold = threshold
+        self.callback = callback
+        self.counts = {}
+        self._thread = threading.current_thread()
+        self._info = {}  # 指纹: (model, method, 调用位置集合)
+        self._pending = {}  # 模型: 尚未加载的 LazyRow 列表
+
+    def __call__(self, event):
+        if threading.current_thread() is not self._thread:
+            return
+        fp = event.fingerprint
+        count = self.counts[fp] = self.counts.get(fp, 0) + 1
+        info = self._info.get(fp)
+        if info is None:
+            info = self._info[fp] = (event.model, event.method, set())
+        info[2].add(event.call_site)
+        if count == self.threshold:
+            logging.warning('[HqOrm N+1]: %s.%s executed %s times at %s: %s',
+                            event.model.__name__ if event.model else '-', event.method, count, event.call_site, fp)
+            if self.callback:
+                self.callback(event, count)
+
+    def report(self):
+        """ 执行次数达到 threshold 的语句, 按次数倒序
+            return: [{'fingerprint', 'count', 'model', 'method', 'call_sites'}, ...]
+        """
+        result = []
+        for fp, count in self.counts.items():
+            if count >= self.threshold:
+                model, method, sites = self._info[fp]
+                result.append({'fingerprint': fp, 'count': count, 'model': model, 'method': method,
+                               'call_sites': sorted(s for s in sites if s)})
+        result.sort(key=lambda d: d['count'], reverse=True)
+        return result
+
+    def defer(self, model, key):
+        row = LazyRow(self, model, key)
+        self._pending.setdefault(model, []).append(row)
+        return row
+
+    def _load(self, model):
+        """ 用一条 IN 语句加载该模型所有待加载的对象
+        """
+        rows = self._pending.pop(model, [])
+        if not rows:
+            return
+        try:
+            found = model.get_many([r._key for r in rows])
+        except Exception:
+            self._pending[model] = rows + self._pending.get(model, [])
+            raise
+        for r in rows:
+            object.__setattr__(r, '_obj', found.get(r._key))
+
+
+class LazyRow(object):
+    """ auto_batch 模式下 get(id=...) 返回的延迟对象, 第一次使用时与同模型其他待加载的对象一起查询
+        属性读写、下标、真值判断转发给加载的对象; 行不存在时真值为 False
+        注意: isinstance 判断不会触发加载, `is None` 判断总是 False, 需要用真值判断
+    """
+
+    __slots__ = ('_detector', '_model', '_key', '_obj')
+
+    def __init__(self, detector, model, key):
+        object.__setattr__(self, '_detector', detector)
+        object.__setattr__(self, '_model', model)
+        object.__setattr__(self, '_key', key)
+        object.__setattr__(self, '_obj', _MISSING)
+
+    def _resolve(self):
+        if self._obj is _MISSING:
+            self._detector._load(self._model)
+        return self._obj
+
+    @property
+    def __class__(self):
+        return self._model
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._resolve(), name, value)
+
+    def __getitem__(self, key):
+        return self._resolve()[key]
+
+    def __nonzero__(self):
+        return self._resolve() is not None
+
+    __bool__ = __nonzero__
+
+    def __eq__(self, other):
+        if isinstance(other, LazyRow):
+            other = other._resolve()
+        return self._resolve() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        if self._obj is _MISSING:
+            return '<LazyRow %s id=%r>' % (self._model.__name__, self._key)
+        return repr(self._obj)
+
+
+@contextlib.contextmanager
+def detect_n_plus_one(threshold=5, auto_batch=False, callback=None):
+    """ 在一次请求范围内检测 N+1 查询
+        with detect_n_plus_one() as d:
+            answers = [Answer.get(id=q.last_answer_id) for q in Question.find(status=1)]
+        d.report()
+        auto_batch: 开启后块内的 Model.get(id=...) 返回 LazyRow, 同一模型待加载的对象在第一次使用时
+            合并成一条 get_many 查询; 事务中的 get 不受影响
+    """
+    detector = NPlusOneDetector(threshold, callback)
+    add_listener(detector)
+    prev = getattr(_session, 'batcher', None)
+    if auto_batch:
+        _session.batcher = detector
+    try:
+        yield detector
+    finally:
+        remove_listener(detector)
+        _session.batcher = prev
+
+
+# ---------------- 关联 ---------------------
+
+# 按类名登记的模型, 关联可以用类名字符串引用尚未定义的模型
+_models = {}
+
+
+class Relation(object):
+    """ 关联声明的基类, 作为模型的类属性使用, 第一次访问时查询并缓存在实例中
+        del obj.name 可以清除缓存, 修改外键列后需要这样做
+    """
+
+    many = False
+
+    def __init__(self, model):
+        self._model = model
+        self.name = None  # 由元类设置为类属性名
+
+    @property
+    def target(self):
+        if isinstance(self._model, (str, unicode)):
+            if self._model not in _models:
+                raise SqlValueError('unknown model %r in relation %r' % (self._model, self.name))
+            self._model = _models[self._model]
+        return self._model
+
+    def __get__(self, obj, owner):
+        if obj is None:
+            return self
+        value = obj.__dict__[self.name] = self.load(obj)
+        return value
+
+
+class ForeignKey(Relation):
+    """ 多对一: obj.column 对应 model.to 的一个对象, 不存在时为 None
+        user = ForeignKey('User', 'user_id')
+    """
+
+    def __init__(self, model, column, to='id'):
+        super(ForeignKey, self).__init__(model)
+        self.column = column
+        self.to = to
+
+    def load(self, obj):
+        value = getattr(obj, self.column, None)
+        if value is None:
+            return None
+        return self.target.get(**{self.to: value})
+
+    def prefetch(self, objs):
+        """ 用 IN 语句批量加载, 返回加载到的对象列表
+        """
+        target = self.target
+        keys = [getattr(o, self.column, None) for o in objs]
+        ids = list(OrderedDict.fromkeys(k for k in keys if k is not None))
+        if self.to == 'id':
+            found = target.get_many(ids)
+        else:
+            found = {}
+            for n in range(0, len(ids), target._in_chunk):
+                for r in target.find(**{self.to + '__in': ids[n:n + target._in_chunk]}):
+                    found[getattr(r, self.to)] = r
+        for o, k in zip(objs, keys):
+            o.__dict__[self.name] = found.get(k) if k is not None else None
+        return [r for r in found.values() if r is not None]
+
+
+class HasMany(Relation):
+    """ 一对多: model 中 column 等于 obj.key 的对象列表
+        answers = HasMany('Answer', 'question_id', order_by='id')
+    """
+
+    many = True
+
+    def __init__(self, model, column, key='id', order_by=''):
+        super(HasMany, self).__init__(model)
+        self.column = column
+        self.key = key
+        self.order_by = order_by
+
+    def load(self, obj):
+        value = getattr(obj, self.key, None)
+        if value is None:
+            return []
+        return self.target.find(order_by=self.order_by, **{self.column: value})
+
+    def prefetch(self, objs):
+        target = self.target
+        keys = [getattr(o, self.key, None) for o in objs]
+        ids = list(OrderedDict.fromkeys(k for k in keys if k is not None))
+        groups = {}
+        related = []
+        for n in range(0, len(ids), target._in_chunk):
+            rs = target.find(order_by=self.order_by, **{self.column + '__in': ids[n:n + target._in_chunk]})
+            for r in rs:
+                groups.setdefault(getattr(r, self.column), []).append(r)
+            related.extend(rs)
+        for o, k in zip(objs, keys):
+            o.__dict__[self.name] = list(groups.get(k, ()))
+        return related
+
+
+# ---------------- 部分加载 ---------------------
+
+def _slot_value(obj, key):
+    """ 读取已加载的列值, 未加载时返回 _MISSING, 不触发部分加载对象的延迟加载
+    """
+    try:
+        return object.__getattribute__(obj, key)
+    except AttributeError:
+        return _MISSING
+
+
+class _Deferred(object):
+    """ 同一次查询得到的部分加载对象, 任一对象第一次访问未加载的列时, 用 IN 语句为整批对象加载这些列
+    """
+
+    __slots__ = ('model', 'objs', 'columns')
+
+    def __init__(self, model, objs, columns):
+        self.model = model
+        self.objs = objs
+        self.columns = columns
+
+    def load(self):
+        objs, self.objs = self.objs, []
+        model = self.model
+        by_id = OrderedDict()
+        for o in objs:
+            by_id.setdefault(o.id, []).append(o)
+        ids = list(by_id)
+        fields = ['id'] + list(self.columns)
+        set_ = object.__setattr__
+        for n in range(0, len(ids), model._in_chunk):
+            for d in model.find(fields=fields, id__in=ids[n:n + model._in_chunk]):
+                for o in by_id.get(d['id'], ()):
+                    for c in self.columns:
+                        # 加载前已赋值的列保留新值
+                        if _slot_value(o, c) is _MISSING:
+                            set_(o, c, d[c])
+        for o in objs:
+            set_(o, '_deferred', None)
+
+
+# ---------------- 计数器 ---------------------
+
+class CounterBuffer(object):
+    """ 计数写缓冲, 按 (id, 列) 合并增量, 由后台线程每 interval 秒用 incr_many 批量写入
+        buf = CounterBuffer(Question, interval=1)
+        buf.incr(qid, answer_count=1)
+        buf.close()  # 停止后台线程并写入剩余的增量, 进程退出时也会自动调用
+        max_pending: 待写入的 (id, 列) 数达到该值时立即唤醒后台线程写入
+        写入失败时增量放回缓冲, 下次再写; 调用方的事务不影响缓冲的写入
+    """
+
+    def __init__(self, model, interval=1.0, max_pending=1000, flush_at_exit=True):
+        self.model = model
+        self.interval = interval
+        self.max_pending = max_pending
+        self.flushes = 0
+        self.errors = 0
+        self._pending = {}  # id: {列: 增量}
+        self._size = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = None
+        if flush_at_exit:
+            atexit.register(self.close)
+
+    def incr(self, id, **deltas):
+        if self._closed:
+            raise SqlValueError('counter buffer is closed')
+        for col in deltas:
+            if col not in self.model._row_set:
+                raise SqlValueError('unknown column: %s' % col)
+        with self._lock:
+            cols = self._pending.setdefault(id, {})
+            for col, n in deltas.items():
+                if col not in cols:
+                    cols[col] = 0
+                    self._size += 1
+                cols[col] += n
+            size = self._size
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='tornorm-counter')
+                self._thread.daemon = True
+                self._thread.start()
+        if size >= self.max_pending:
+            self._wake.set()
+
+    def pending(self):
+        """ 尚未写入的增量 {id: {列: 增量}}
+        """
+        with self._lock:
+            return dict((k, dict(v)) for k, v in self._pending.items())
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as ex:
+                logging.error('[HqOrm counter]: %s %r', self.model._table_name, ex)
+
+    def flush(self):
+        """ 写入当前所有增量, 返回执行的语句数
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending, self._size = self._pending, {}, 0
+            if not pending:
+                return 0
+            try:
+                n = self.model.incr_many(pending)
+            except Exception:
+                self.errors += 1
+                with self._lock:
+                    for id, cols in pending.items():
+                        current = self._pending.setdefault(id, {})
+                        for col, delta in cols.items():
+                            if col not in current:
+                                current[col] = 0
+                                self._size += 1
+                            current[col] += delta
+                raise
+            self.flushes += 1
+            return n
+
+    def close(self):
+        """ 停止后台线程并写入剩余的增量
+        """
+        self._closed = True
+        self._wake.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {'pending': self._size, 'flushes': self.flushes, 'errors': self.errors}
+
+
+# ---------------- 查询缓存 ---------------------
+
+class _Flight(object):
+    """ 正在执行的查询, 同一缓存键的并发未命中等待它的结果
+    """
+
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+_version_seq = itertools.count()
+
+
+def _new_version():
+    """ 新的表版本号, 多个进程共用缓存后端时也不会重复
+    """
+    return '%x.%x.%x' % (int(time.time() * 1000), os.getpid(), next(_version_seq))
+
+
+def _singleflight(key, fn):
+    """ 同一个键同时只执行一次 fn, 其他线程等待并共用结果
+        return: (结果, 是否等待了其他线程的结果)
+    """
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+    if not leader:
+        flight.event.wait()
+        if flight.error is None:
+            return flight.result, True
+        # 执行的线程出错时自己再查询一次
+        return fn(), False
+    try:
+        flight.result = fn()
+        return flight.result, False
+    except Exception as ex:
+        flight.error = ex
+        raise
+    finally:
+        with _flights_lock:
+            _flights.pop(key, None)
+        flight.event.set()
+
+
+# ---------------- 并行扫描 ---------------------
+
+def _scan_partition(model, lo, hi, row_type, fields, args, kwargs):
+    """ 按id顺序读取一个分区 [lo, hi] 的数据, 在线程池或进程池中执行
+    """
+    kwargs = dict(kwargs, id__between=(lo, hi))
+    if row_type == 'columns':
+        return model.find(args=args, fields=fields, order_by='id', columnar=True, **kwargs)
+    if row_type == 'dict':
+        return model.find(args=args, fields=fields or model._rows, order_by='id', **kwargs)
+    return model.find(args=args, only=fields, order_by='id', **kwargs)
+
+
+def _split_range(lo, hi, n):
+    """ 把 [lo, hi] 等分为最多 n 个区间
+    """
+    step = max((hi - lo + n) // n, 1)
+    return [(b, min(b + step - 1, hi)) for b in range(lo, hi + 1, step)]
+
+
+def _split_samples(lo, hi, samples, n):
+    """ 按采样的id分位数把 [lo, hi] 分为最多 n 个区间, 使各分区行数接近
+    """
+    samples = sorted(samples)
+    bounds = [lo]
+    for i in range(1, n):
+        b = samples[len(samples) * i // n] if samples else None
+        if b is not None and bounds[-1] < b <= hi:
+            bounds.append(b)
+    return [(b, (bounds[i + 1] - 1) if i + 1 < len(bounds) else hi) for i, b in enumerate(bounds)]
+
+
+class _ModelState(object):
+    """ 每个模型独立的运行时状态
+    """
+
+    def __init__(self, model):
+        self.stmt_cache = LRUCache(model._stmt_cache_size)
+        self.version = 0  # 写操作计数, 读取期间有写操作时不回填缓存
+        self.row_stats = {'hits': 0, 'misses': 0, 'negative_hits': 0, 'stale_skips': 0, 'invalidations': 0}
+        self.replicas = None  # _db_replicas 为连接列表时包装成的 ReplicaSet
+        self.counts = LRUCache(model._count_cache_size, ttl=model._count_ttl)
+        self.count_stats = {'hits': 0, 'misses': 0, 'approx': 0}
+        self.query_stats = {}  # sql: {'hits', 'misses', 'coalesced'}
+
+
+class ModelMeta(type):
+    """ 模型元类, 根据 _rows 生成 __slots__, 列数据存在槽中而不是实例字典中
+        并收集关联声明到 _relations, 按类名登记模型
+    """
+
+    def __new__(mcs, name, bases, attrs):
+        rows = attrs.get('_rows')
+        if rows and '__slots__' not in attrs:
+            inherited = set()
+            for base in bases:
+                for c in base.__mro__:
+                    inherited.update(c.__dict__.get('__slots__', ()))
+            # 与类属性或基类属性(如 page/get/delete 等方法)同名的列不能作为槽, 否则槽会覆盖该属性,
+            # 这些列仍存放在实例字典中
+            attrs['__slots__'] = tuple(r for r in rows if r not in inherited and r not in attrs and
+                                       not any(hasattr(b, r) for b in bases))
+        cls = type.__new__(mcs, name, bases, attrs)
+        cls._row_set = frozenset(cls._rows or ())
+        relations = {}
+        for base in reversed(bases):
+            relations.update(getattr(base, '_relations', {}))
+        for k, v in attrs.items():
+            if isinstance(v, Relation):
+                v.name = k
+                relations[k] = v
+        cls._relations = relations
+        _models[name] = cls
+        return cls
+
+
+class Base(object):
+
+    __metaclass__ = ModelMeta
+    # 列数据由元类生成槽保存, __dict__ 只在设置额外属性时才创建
+    # _deferred: only/defer 查询得到的部分加载对象的 _Deferred
+    __slots__ = ('_changed', '_deferred', '__dict__', '__weakref__')
+
+    # 必须在子类中重置的属性
+    _table_name = None  # 数据库表名
+    _rows = None  # 表列名
+    _db_conn = None  # 数据库连接或连接池, 也可以重写 get_conn 方法
+    # 从库: ReplicaSet 或连接列表, 设置后读操作(get/find/page/number/all等)使用从库
+    # 事务中以及写操作后 _ryw_window 秒内, 当前线程的读操作仍使用主库
+    _db_replicas = None
+    _ryw_window = 2
+    # 是否打印sql语句
+    _echo = False
+
+    # 可选提供属性
+    per_page = 10
+    # 已编译sql语句的缓存条数, 0 为不缓存
+    _stmt_cache_size = 256
+    # 异步方法使用的线程池, 默认使用模块共享的线程池
+    _executor = None
+    # bulk_insert 每条语句的最大字节数, 需小于mysql的 max_allowed_packet
+    _max_packet = 1024 * 1024
+    # new 之后是否重新查询整行, False 时用插入的值和 lastrowid 直接构建对象, 只需一次交互
+    _refetch_on_new = True
+    # 有数据库默认值的列, 不重新查询整行时, 只单独查询插入时未提供的这些列
+    _default_rows = ()
+
+    # save_all 每条语句最多更新的对象数
+    _batch_size = 500
+    # get_many 每条 IN 语句最多查询的id数
+    _in_chunk = 1000
+    # 行缓存: 设置为 LRUCache 或 CacheBackend 的实现后, 按 _row_cache_keys 中的列 get 时先查缓存
+    # 本模型的写操作会使缓存失效, 直接执行的sql(execute_sql)不会
+    _row_cache = None
+    _row_cache_keys = ('id', )  # 主键及唯一键
+    _row_cache_ttl = None  # 过期秒数, None 使用后端的默认值
+    _row_cache_negative = True  # 是否缓存不存在的行
+    # paginate 计数缓存的秒数和条数, 本模型的写操作会清空计数缓存
+    _count_ttl = 60
+    _count_cache_size = 1024
+    # paginate(count='approx') 估算行数不小于该值时直接使用估算值, 否则精确计数
+    _approx_threshold = 100000
+    # 查询结果缓存: 设置为 LRUCache 或 CacheBackend 的实现后, find/page/all/number 传入 cache=True
+    # (或过期秒数)时按sql和参数缓存结果; 本模型的写操作更新缓存中的表版本号, 旧结果不再命中
+    # 多个进程共用外部缓存后端时, 写操作同样使其他进程的缓存失效; 直接执行的sql(execute_sql)不会
+    _query_cache = None
+    _query_cache_ttl = 60
+
+    def __init__(self, data):
+        """ data must be a dict
+        """
+        rows = self._row_set
+        for k in data:
+            if k in rows:
+                object.__setattr__(self, k, data[k])
+        # 被修改过的列及其原始值, 每个对象独立
+        object.__setattr__(self, '_changed', {})
+
+    def __setattr__(self, key, value):
+        """ 设置属性, 记录被修改列的原始值
+        """
+        if key in self._row_set:
+            changed = getattr(self, '_changed', None)
+            if changed is None:
+                changed = {}
+                object.__setattr__(self, '_changed', changed)
+            if key not in changed:
+                changed[key] = _slot_value(self, key)
+        object.__setattr__(self, key, value)
+
+    def __getattr__(self, name):
+        """ 部分加载的对象访问未加载的列时, 为同一批对象加载剩余的列
+        """
+        if name in self._row_set:
+            deferred = _slot_value(self, '_deferred')
+            if deferred is not _MISSING and deferred is not None:
+                deferred.load()
+                return object.__getattribute__(self, name)
+        raise AttributeError(name)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for k in self._rows:
+            v = _slot_value(self, k)
+            if v is not _MISSING:
+                state[k] = v
+        state['_changed'] = getattr(self, '_changed', {})
+        return state
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            object.__setattr__(self, k, v)
+
+    @classmethod
+    def _from_rows(cls, ds):
+        """ 从数据库结果快速构建对象列表, 子类重写了 __init__ 时仍调用 __init__
+        """
+        if cls.__init__.im_func is not Base.__init__.im_func:
+            return [cls(d) for d in ds]
+        if not ds:
+            return []
+        rows = cls._row_set
+        new = object.__new__
+        set_ = object.__setattr__
+        keys = None
+        objs = []
+        for d in ds:
+            if keys is None:
+                # 同一结果集的列相同, 只需计算一次
+                keys = [k for k in d if k in rows]
+            o = new(cls)
+            for k in keys:
+                set_(o, k, d[k])
+            set_(o, '_changed', {})
+            objs.append(o)
+        return objs
+
+    def __getitem__(self, key):
+        """ 中括号操作支持
+        """
+        if hasattr(self, key):
+            return getattr(self, key)
+        raise KeyError
+
+    @classmethod
+    def get_conn(cls):
+        if cls._db_conn is None:
+            raise Exception('must define get_conn method or _db_conn')
+        return _pinned_conn(cls._db_conn)
+
+    @classmethod
+    def _primary_conn(cls):
+        """ 主库连接; 子类重写了 get_conn 时, 也使用当前线程在其上进行中的事务独占的连接
+        """
+        return _pinned_conn(cls.get_conn())
+
+    @classmethod
+    def _read_replica(cls):
+        """ 读操作可以使用从库时, 返回 (从库集合, 选中的序号), 否则返回 (None, None)
+        """
+        replicas = cls._replicas()
+        if replicas is None or _in_transaction():
+            return None, None
+        wrote = _last_writes().get(cls)
+        if wrote is not None and time.time() - wrote < cls._ryw_window:
+            return None, None
+        return replicas, replicas.choose()
+
+    @classmethod
+    def _replicas(cls):
+        replicas = cls._db_replicas
+        if replicas is None or isinstance(replicas, ReplicaSet):
+            return replicas
+        state = cls._state()
+        if state.replicas is None or state.replicas.replicas != list(replicas):
+            state.replicas = ReplicaSet(replicas)
+        return state.replicas
+
+    @classmethod
+    def get_read_conn(cls):
+        """ 读操作使用的连接
+        """
+        replicas, i = cls._read_replica()
+        if i is None:
+            return cls._primary_conn()
+        return replicas.replicas[i]
+
+    @classmethod
+    def _execute_read(cls, sql, values, mode='query'):
+        """ 执行读语句, 有可用的从库时在从库执行, 从库连接出错时回退到主库
+        """
+        replicas, i = cls._read_replica()
+        if i is not None:
+            try:
+                return replicas.execute(i, sql, values, mode, echo=cls._echo)
+            except Exception as ex:
+                if not _is_disconnect(ex):
+                    raise
+                logging.warning('[HqOrm replica]: %s %r', cls._table_name, ex)
+                replicas.mark_down(i)
+        _db_con = cls._primary_conn()
+        return _execute_sql(sql, values, db_con=_db_con, mode=mode, echo=cls._echo)
+
+    @classmethod
+    def _state(cls):
+        """ 每个模型独立的运行时状态
+        """
+        state = cls.__dict__.get('_state_obj')
+        if state is None:
+            state = _ModelState(cls)
+            setattr(cls, '_state_obj', state)
+        return state
+
+    @classmethod
+    def _stmt_cache(cls):
+        """ 每个模型独立的sql编译缓存
+        """
+        return cls._state().stmt_cache
+
+    @classmethod
+    def _row_generation(cls):
+        """ 行缓存代数, 存放在缓存后端中, 共享后端的多个进程一起失效
+            无法确定受影响的行时换新代数
+        """
+        backend = cls._row_cache
+        generation = backend.get(cls._table_name + ':rgen')
+        if generation is None:
+            generation = _new_version()
+            backend.set(cls._table_name + ':rgen', generation)
+        return generation
+
+    @classmethod
+    def _row_key(cls, col, value, generation=None):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        if generation is None:
+            generation = cls._row_generation()
+        return '%s:%s:%s:%s' % (cls._table_name, generation, col, value)
+
+    @classmethod
+    def _id_rows(cls, kwargs, args=None):
+        """ 条件只按 id 过滤时返回受影响行的 id 列表, 供 _on_write 精确失效; 否则返回 None
+            行缓存还有其它键列时无法得知这些列的值, 也返回 None
+        """
+        if args or len(kwargs) != 1 or tuple(cls._row_cache_keys) != ('id',):
+            return None
+        col, value = kwargs.items()[0]
+        if col == 'id' and not isinstance(value, (list, tuple, set)):
+            return [{'id': value}]
+        if col == 'id__in' and isinstance(value, (list, tuple, set)):
+            return [{'id': i} for i in value]
+        return None
 
+    @classmethod
+    def _row_cache_key(cls, kwargs):
+        """ 可以使用行缓存的 get 返回缓存键, 否则返回 None
+        """
+        if cls._row_cache is None or len(kwargs) != 1:
+            return None
+        col, value = kwargs.items()[0]
+        if col not in cls._row_cache_keys or isinstance(value, (list, tuple)):
+            return None
+        return cls._row_key(col, value)
 
-def _execute_sql(sql, values, db_con, mode='execute', echo=False):
-    """ 连接到数据库执行sql语句, mode: execute/get/query
-    """
-    if echo:
-        logging.info('[HqOrm Gen-SQL]:' + sql % tuple(values))
-    return getattr(db_con, mode)(sql, *values)
+    @classmethod
+    def _cached_get(cls, key, sql, values):
+        """ 先查行缓存, 未命中时查询数据库并回填
+        """
+        state = cls._state()
+        stats = state.row_stats
+        row = cls._row_cache.get(key)
+        if row is not None:
+            if not row:
+                stats['negative_hits'] += 1
+                return None
+            stats['hits'] += 1
+            return cls(row)
+        stats['misses'] += 1
+        version = state.version
+        o = cls._execute_read(sql, values, mode='get')
+        if (o or cls._row_cache_negative) and not _in_transaction():
+            if state.version == version:
+                cls._row_cache.set(key, dict(o) if o else {}, cls._row_cache_ttl)
+            else:
+                # 读取期间有写操作, 结果可能已过期
+                stats['stale_skips'] += 1
+        return cls(o) if o else None
 
+    @classmethod
+    def row_cache_info(cls):
+        """ 行缓存统计: hits/misses/negative_hits/stale_skips/invalidations/hit_ratio 及后端统计
+        """
+        info = dict(cls._state().row_stats)
+        if cls._row_cache is not None:
+            info.update(('backend_' + k, v) for k, v in cls._row_cache.stats().items())
+        total = info['hits'] + info['negative_hits'] + info['misses']
+        info['hit_ratio'] = float(info['hits'] + info['negative_hits']) / total if total else 0.0
+        return info
 
-class Base(object):
+    @classmethod
+    def _cached_read(cls, sql, values, mode, cache):
+        """ 读语句的结果缓存, 缓存键包含表版本号; 事务中不使用缓存
+            同一缓存键的并发未命中合并为一次查询
+        """
+        backend = cls._query_cache
+        if not cache or backend is None or _in_transaction():
+            return cls._execute_read(sql, values, mode=mode)
+        ttl = cls._query_cache_ttl if cache is True else cache
+        stats = cls._state().query_stats.get(sql)
+        if stats is None:
+            stats = cls._state().query_stats.setdefault(sql, {'hits': 0, 'misses': 0, 'coalesced': 0})
+        version = backend.get(cls._table_name + ':qver')
+        if version is None:
+            version = _new_version()
+            backend.set(cls._table_name + ':qver', version)
+        raw = sql + repr(tuple(values))
+        if isinstance(raw, unicode):
+            raw = raw.encode('utf-8')
+        digest = hashlib.md5(raw).hexdigest()
+        key = '%s:q:%s:%s' % (cls._table_name, version, digest)
+        # 缓存值包装为单元素列表, 结果为 None 时也能缓存
+        hit = backend.get(key)
+        if hit is not None:
+            stats['hits'] += 1
+            return hit[0]
+
+        def load():
+            result = cls._execute_read(sql, values, mode=mode)
+            backend.set(key, [result], ttl)
+            return result
+        result, coalesced = _singleflight(key, load)
+        stats['coalesced' if coalesced else 'misses'] += 1
+        return result
 
-    # 必须在子类中重置的属性
-    _table_name = None  # 数据库表名
-    _rows = None  # 表列名
-    # 是否打印sql语句
-    _echo = False
+    @classmethod
+    def query_cache_info(cls):
+        """ 查询结果缓存统计, 按sql语句: {sql: {'hits', 'misses', 'coalesced', 'hit_ratio'}}
+            coalesced: 等待其他线程的同一查询而没有访问数据库的次数, 计入命中率
+        """
+        info = {}
+        for sql, stats in cls._state().query_stats.items():
+            stats = dict(stats)
+            total = stats['hits'] + stats['misses'] + stats['coalesced']
+            stats['hit_ratio'] = float(stats['hits'] + stats['coalesced']) / total if total else 0.0
+            info[sql] = stats
+        return info
 
-    # 可选提供属性
-    per_page = 10
+    @classmethod
+    def _write_started(cls):
+        cls._state().version += 1
 
-    # 内置属性, 外部不使用
-    __dirty_data = {}
+    @classmethod
+    def _on_write(cls, rows=None, writes=None):
+        """ 写操作完成后调用, 使缓存失效
+            rows: 受影响行的列值(字典或对象)列表, None 表示无法确定受影响的行
+            writes: 记录写入时间(读己之写)的会话字典, 默认为当前线程的
+        """
+        state = cls._state()
+        state.version += 1
+        txs = getattr(_session, 'txs', None)
+        if txs and (cls._row_cache is not None or cls._query_cache is not None):
+            for tx in txs.values():
+                tx.writes.append((cls, rows))
+        if cls._query_cache is not None:
+            cls._query_cache.set(cls._table_name + ':qver', _new_version())
+        if cls._db_replicas is not None and cls._ryw_window:
+            (writes if writes is not None else _last_writes())[cls] = time.time()
+        if len(state.counts):
+            state.counts.clear()
+        cache = cls._row_cache
+        if cache is None:
+            return
+        state.row_stats['invalidations'] += 1
+        if rows is None:
+            cache.set(cls._table_name + ':rgen', _new_version())
+            return
+        generation = cls._row_generation()
+        for row in rows:
+            for col in cls._row_cache_keys:
+                v = row.get(col, _MISSING) if isinstance(row, dict) else getattr(row, col, _MISSING)
+                if v is not _MISSING:
+                    cache.delete(cls._row_key(col, v, generation))
 
-    def __init__(self, data):
-        """ data must be a dict
+    @classmethod
+    def _execute_write(cls, sql, values, mode='execute', rows=None):
+        """ 执行写语句, 执行前后通知缓存
+            rows: 同 _on_write
         """
-        for k in data:
-            if k in self._rows:
-                self.__setattr__(k, data[k])
-        self.__dirty_data.clear()
+        cls._write_started()
+        try:
+            _db_con = cls._primary_conn()
+            return _execute_sql(sql, values, db_con=_db_con, mode=mode, echo=cls._echo)
+        finally:
+            cls._on_write(rows)
 
-    def __setattr__(self, key, value):
-        """ 设置属性
+    @classmethod
+    def _compiled(cls, key, build):
+        """ 按语句形状取已编译的sql, 未命中时调用 build() 编译并缓存
         """
-        object.__setattr__(self, key, value)
-        if key in self._rows:
-            self.__dirty_data[key] = value
+        if _listeners:
+            _session.bind_start = time.time()
+        if not cls._stmt_cache_size:
+            return build()
+        cache = cls._stmt_cache()
+        stmt = cache.get(key)
+        if stmt is None:
+            stmt = cache.set(key, build())
+        return stmt
 
-    def __getitem__(self, key):
-        """ 中括号操作支持
+    @classmethod
+    def stmt_cache_info(cls):
+        """ sql编译缓存统计: hits/misses/evictions/size/maxsize
         """
-        if hasattr(self, key):
-            return getattr(self, key)
-        raise KeyError
+        return cls._stmt_cache().stats()
 
     @classmethod
-    def get_conn(cls):
-        raise Exception('must define get_conn method')
+    def transaction(cls, batch=True):
+        """ 事务上下文, 见 Transaction
+            with Model.transaction() as tx: ...
+        """
+        return Transaction(cls, batch=batch)
 
     @classmethod
     def begin(cls):
-        cls.execute_sql('begin;', [], mode='execute')
+        """ 开始事务, 与 commit/rollback 配对使用, 推荐使用 transaction()
+        """
+        tx = cls.transaction().__enter__()
+        stack = getattr(_session, 'manual_txs', None)
+        if stack is None:
+            stack = _session.manual_txs = []
+        stack.append(tx)
 
     @classmethod
     def commit(cls):
-        cls.execute_sql('commit;', [], mode='execute')
+        stack = getattr(_session, 'manual_txs', None)
+        if stack:
+            stack.pop().commit()
+        else:
+            cls.execute_sql('commit;', [], mode='execute')
 
     @classmethod
     def rollback(cls):
-        cls.execute_sql('rollback;', [], mode='execute')
+        stack = getattr(_session, 'manual_txs', None)
+        if stack:
+            stack.pop().rollback()
+        else:
+            cls.execute_sql('rollback;', [], mode='execute')
+
+    @classmethod
+    def replica_info(cls):
+        """ 从库统计: 各从库的读次数/错误次数/平均耗时/延迟, 以及回退到主库的次数
+        """
+        replicas = cls._replicas()
+        return replicas.stats() if replicas is not None else {}
 
     # 定义类级别的操作方法
     @classmethod
-    def new(cls, commit=True, **kwargs):
+    def new(cls, commit=True, refetch=None, **kwargs):
         """ 新建一条记录并保存到数据库, 返回对象
+            refetch: 是否重新查询整行, 默认为 _refetch_on_new
         """
         if not kwargs:
             return None
@@ -229,8 +2455,7 @@ class Base(object):
         max_try = 3
         for i in range(max_try):
             try:
-                _db_con = cls.get_conn()
-                nid = _execute_sql(sql, values, db_con=_db_con, mode='execute', echo=cls._echo)
+                nid = cls._execute_write(sql, values, mode='execute', rows=[kwargs])
             except Exception as ex:
                 if ex[0] == 1062:
                     continue
@@ -239,11 +2464,30 @@ class Base(object):
             break
         else:
             raise Exception(cls.__name__ + ' error', ex[1])
+        if not xid:
+            cls._on_write([{'id': nid}])
         nid = xid or nid
-        add = cls.get(id=nid)
-        add.__dirty_data.clear()
+        if refetch is None:
+            refetch = cls._refetch_on_new
+        if refetch:
+            add = cls.get(id=nid)
+        else:
+            missing = [k for k in cls._default_rows if k not in kwargs]
+            add = cls._from_insert(kwargs, nid, cls.get(fields=missing, id=nid) if missing else None)
         return add  # 返回对象
 
+    @classmethod
+    def _from_insert(cls, kwargs, nid, defaults=None):
+        """ 用插入的值构建新对象, 未提供的列为 None
+            defaults: 单独查询到的默认值列
+        """
+        data = dict.fromkeys(cls._rows)
+        data.update(kwargs)
+        data['id'] = nid
+        if defaults:
+            data.update(defaults)
+        return cls(data)
+
     @classmethod
     def new_mul(cls, commit=True, *items):
         """ 新建多个记录到数据库, 返回新建对象列表, 参数items为字典列表
@@ -273,34 +2517,186 @@ class Base(object):
         sql = 'INSERT INTO `' + cls._table_name + '` (' + sql_rows + ') VALUES ' + row_values
         if not commit:
             return sql, values
-        _db_con = cls.get_conn()
         try:
-            fid = _execute_sql(sql, values, db_con=_db_con, mode='execute', echo=cls._echo)
+            fid = cls._execute_write(sql, values, mode='execute')
             return fid
         except Exception as ex:
             logging.error('[HqDB news]: ' + repr(ex))
             return None
 
     @classmethod
-    def get(cls, fields=None, commit=True, **kwargs):
+    def _bulk_chunk(cls, chunk, size, ignore, on_duplicate, as_objects, commit):
+        """ 插入一批数据, 缺少的列使用 DEFAULT
+        """
+        keys = set()
+        for d in chunk:
+            keys.update(d)
+        if not keys.issubset(set(cls._rows)):
+            raise BuildArgsError(''.join((str(list(keys)), '<>', str(cls._rows))))
+        keys = [k for k in cls._rows if k in keys]
+        values = []
+        rows_sql = []
+        for d in chunk:
+            marks = []
+            for k in keys:
+                if k in d:
+                    marks.append('%s')
+                    values.append(d[k])
+                else:
+                    marks.append('DEFAULT')
+            rows_sql.append('(' + ','.join(marks) + ')')
+        sql = ''.join(
+            ('INSERT ', 'IGNORE ' if ignore else '', 'INTO `', cls._table_name, '` (', list_to_sql(keys),
+             ') VALUES ', ','.join(rows_sql))
+        )
+        if on_duplicate:
+            if not isinstance(on_duplicate, (str, unicode)):
+                on_duplicate = ','.join(['`%s`=VALUES(`%s`)' % (k, k) for k in on_duplicate])
+            sql = ''.join((sql, ' ON DUPLICATE KEY UPDATE ', on_duplicate))
+        if not commit:
+            return sql, values
+        start = time.time()
+        nid = cls._execute_write(sql, values, mode='execute')
+        result = {'rows': len(chunk), 'bytes': size, 'time': time.time() - start, 'ids': None}
+        if 'id' in keys and all('id' in d for d in chunk):
+            ids = [d['id'] for d in chunk]
+        elif 'id' not in keys and nid and not ignore and not on_duplicate:
+            # 多行插入时 lastrowid 为第一行的id, innodb_autoinc_lock_mode 为 0/1 时id连续
+            ids = range(nid, nid + len(chunk))
+        else:
+            ids = None
+        if ids:
+            result['ids'] = (ids[0], ids[-1])
+            if as_objects:
+                result['objects'] = [cls._from_insert(d, i) for d, i in zip(chunk, ids)]
+        return result
+
+    @classmethod
+    def bulk_insert(cls, items, chunk_size=1000, max_bytes=None, ignore=False, on_duplicate=None,
+                    as_objects=False, report=None, commit=True):
+        """ 分批插入大量数据, items 可以是字典的生成器
+            chunk_size: 每条语句的最大行数
+            max_bytes: 每条语句的最大字节数, 默认为 _max_packet
+            ignore: 使用 INSERT IGNORE
+            on_duplicate: ON DUPLICATE KEY UPDATE 的列名列表, 或直接给出更新表达式字符串
+            as_objects: 在结果中附带新建的对象(不再查询数据库)
+            report: 每批插入完成后的回调, 参数为该批的结果
+            return: 每批的结果列表 [{'ids': (首id, 末id), 'rows': 行数, 'bytes': 字节数, 'time': 耗时}, ...]
+                    使用 ignore/on_duplicate 时无法确定id, ids 为 None
+                    commit=False 时返回每批的 (sql, values) 列表
+        """
+        max_bytes = max_bytes or cls._max_packet
+        results = []
+
+        def flush(chunk, size):
+            result = cls._bulk_chunk(chunk, size, ignore, on_duplicate, as_objects, commit)
+            if commit:
+                logging.debug('[HqOrm bulk]: %s rows=%s bytes=%s time=%.4f', cls._table_name, result['rows'],
+                              result['bytes'], result['time'])
+                if report:
+                    report(result)
+            results.append(result)
+
+        chunk = []
+        size = 0
+        for d in items:
+            row_size = sum(_value_bytes(v) for v in d.itervalues()) + 3
+            if chunk and (len(chunk) >= chunk_size or size + row_size > max_bytes):
+                flush(chunk, size)
+                chunk = []
+                size = 0
+            chunk.append(d)
+            size += row_size
+        if chunk:
+            flush(chunk, size)
+        return results
+
+    @classmethod
+    def get(cls, fields=None, commit=True, only=None, defer=None, **kwargs):
         """ 获取单个对象, 根据id获取, 取得多个对象将导致异常
+            only/defer: 只查询部分列(或不查询某些列)仍返回对象, 其余的列在第一次访问时再查询
         """
+        fields, deferred = cls._projection(fields, only, defer)
         is_o = not fields
+        batcher = getattr(_session, 'batcher', None)
+        if batcher is not None and is_o and commit and kwargs.keys() == ['id'] \
+                and not isinstance(kwargs['id'], (list, tuple)) and not _in_transaction():
+            return batcher.defer(cls, kwargs['id'])
         fields = fields or cls._rows
-        re_str, values = _rebuild_argv(kwargs, rows=cls._rows)
-        _where = ''.join((' WHERE ', re_str)) if re_str else ''
-        sql = ''.join(
-            ('SELECT ', list_to_sql(fields), ' FROM ',  '`', cls._table_name, '`', _where, ' LIMIT 1')
-        )
+        shape = _argv_shape(kwargs)
+
+        def build():
+            re_str, plan = _compile_argv(shape, rows=cls._rows)
+            _where = ''.join((' WHERE ', re_str)) if re_str else ''
+            sql = ''.join(
+                ('SELECT ', list_to_sql(fields), ' FROM ',  '`', cls._table_name, '`', _where, ' LIMIT 1')
+            )
+            return sql, plan
+        sql, plan = cls._compiled(('get', cls._table_name, shape, _fields_key(fields)), build)
+        values = _bind_argv(plan, kwargs)
         if not commit:
             return sql, values
+        cache_key = cls._row_cache_key(kwargs) if is_o else None
+        if cache_key is not None:
+            return cls._cached_get(cache_key, sql, values)
         # sql, values, is_o = cls.__get(tn=cls._table_name, fields=fields, **kwargs)
-        _db_con = cls.get_conn()
-        o = _execute_sql(sql, values, db_con=_db_con, mode="get", echo=cls._echo)
-        if is_o and o:
-            return cls(o)
+        o = cls._execute_read(sql, values, mode='get')
+        if (is_o or deferred) and o:
+            return cls._defer([cls(o)], deferred)[0]
         return o
 
+    @classmethod
+    def get_many(cls, ids, chunk_size=None):
+        """ 按id批量获取对象, 代替循环调用 get
+            ids: id列表, 重复的id只查询一次, 有行缓存时先查缓存
+            chunk_size: 每条 IN 语句最多查询的id数, 默认为 _in_chunk
+            return: OrderedDict {id: 对象}, 按输入顺序, 不存在的id对应 None
+        """
+        chunk_size = chunk_size or cls._in_chunk
+        result = OrderedDict()
+        for i in ids:
+            result[i] = None
+        cache = cls._row_cache if 'id' in cls._row_cache_keys else None
+        state = cls._state()
+        generation = cls._row_generation() if cache is not None else None
+        found = {}
+        rows = {}
+        missing = []
+        for i in result:
+            if cache is not None:
+                row = cache.get(cls._row_key('id', i, generation))
+                if row is not None:
+                    if row:
+                        state.row_stats['hits'] += 1
+                        found[str(i)] = cls(row)
+                    else:
+                        state.row_stats['negative_hits'] += 1
+                    continue
+                state.row_stats['misses'] += 1
+            missing.append(i)
+        version = state.version
+        for n in range(0, len(missing), chunk_size):
+            chunk = missing[n:n + chunk_size]
+            sql, values, is_o = cls.__find(tn=cls._table_name, args=None, join=None, fields=None, order_by='',
+                                           limit='', id__in=chunk)
+            ds = cls._execute_read(sql, values, mode='query')
+            for d, o in zip(ds, cls._from_rows(ds)):
+                found[str(o.id)] = o
+                rows[str(o.id)] = d
+        if cache is not None and missing and not _in_transaction():
+            if state.version == version:
+                for i in missing:
+                    d = rows.get(str(i))
+                    if d is not None:
+                        cache.set(cls._row_key('id', i, generation), dict(d), cls._row_cache_ttl)
+                    elif cls._row_cache_negative:
+                        cache.set(cls._row_key('id', i, generation), {}, cls._row_cache_ttl)
+            else:
+                state.row_stats['stale_skips'] += 1
+        for i in result:
+            result[i] = found.get(str(i))
+        return result
+
     @classmethod
     def exists(cls, **kwargs):
         """ 检查记录是否存在
@@ -310,53 +2706,399 @@ class Base(object):
         return bool(cls.find(fields=('id', ), **kwargs))
 
     @classmethod
-    def __find(cls, tn, args, join, fields, order_by, limit, **kwargs):
+    def _projection(cls, fields, only, defer):
+        """ only/defer 转换为查询的列和未加载的列, 总是查询 id
+            return: (fields, deferred), 没有 only/defer 或没有未加载的列时 deferred 为 None
+        """
+        if not only and not defer:
+            return fields, None
+        if fields:
+            raise SqlValueError('only/defer can not be used with fields')
+        if isinstance(only or defer, (str, unicode)):
+            names = set([only or defer])
+        else:
+            names = set(only or defer)
+        unknown = names - cls._row_set
+        if unknown:
+            raise SqlValueError('unknown columns: %s' % ', '.join(sorted(unknown)))
+        if only:
+            cols = [c for c in cls._rows if c in names or c == 'id']
+        elif 'id' in names:
+            raise SqlValueError('id can not be deferred')
+        else:
+            cols = [c for c in cls._rows if c not in names]
+        deferred = tuple(c for c in cls._rows if c not in cols)
+        if not deferred:
+            return None, None
+        return cols, deferred
+
+    @classmethod
+    def _defer(cls, objs, deferred):
+        """ 标记为部分加载的对象
+        """
+        if objs and deferred:
+            loader = _Deferred(cls, objs, deferred)
+            set_ = object.__setattr__
+            for o in objs:
+                set_(o, '_deferred', loader)
+        return objs
+
+    @classmethod
+    def _relation(cls, name):
+        rel = cls._relations.get(name)
+        if rel is None:
+            raise SqlValueError('%s has no relation %r' % (cls.__name__, name))
+        return rel
+
+    @classmethod
+    def _related_names(cls, select_related, fields):
+        """ 检查 select_related 参数, 返回关联名元组
+        """
+        if isinstance(select_related, (str, unicode)):
+            select_related = (select_related, )
+        related = tuple(select_related or ())
+        if related and fields:
+            raise SqlValueError('select_related can not be used with fields')
+        for name in related:
+            if cls._relation(name).many:
+                raise SqlValueError('select_related only supports ForeignKey: %r' % name)
+        return related
+
+    @classmethod
+    def _select_sql(cls, fields, table, related):
+        """ 查询的列和 select_related 的 LEFT JOIN 语句, 关联表以关联名为别名, 其列以 关联名__列名 为别名
+        """
+        if not related:
+            return list_to_sql(fields, table=table), ''
+        cols = [list_to_sql(fields, table=table)]
+        joins = []
+        for name in related:
+            rel = cls._relations[name]
+            target = rel.target
+            cols.extend('`%s`.`%s` AS `%s__%s`' % (name, c, name, c) for c in target._rows)
+            joins.append(' LEFT JOIN `%s` AS `%s` ON `%s`.`%s`=`%s`.`%s` ' % (
+                target._table_name, name, name, rel.to, cls._table_name, rel.column))
+        return ','.join(cols), ''.join(joins)
+
+    @classmethod
+    def _load_related(cls, ds, related, prefetch_related, deferred=None):
+        """ 构建对象并挂上 select_related 的关联对象, 再批量加载 prefetch_related
+            deferred: 部分加载时未加载的列
+        """
+        objs = cls._defer(cls._from_rows(ds), deferred)
+        for name in related:
+            target = cls._relations[name].target
+            prefix = name + '__'
+            pk = prefix + cls._relations[name].to
+            rows = [d for d in ds if d[pk] is not None]
+            found = iter(target._from_rows([dict((c, d[prefix + c]) for c in target._rows) for d in rows]))
+            for o, d in zip(objs, ds):
+                o.__dict__[name] = next(found) if d[pk] is not None else None
+        if prefetch_related:
+            cls.prefetch(objs, *prefetch_related)
+        return objs
+
+    @classmethod
+    def prefetch(cls, objs, *names):
+        """ 为已有的对象列表批量加载关联, 每个关联一条 IN 语句, 与对象个数无关
+            Question.prefetch(questions, 'user', 'last_answer__user')
+        """
+        for name in names:
+            first, _, rest = name.partition('__')
+            rel = cls._relation(first)
+            if all(first in o.__dict__ for o in objs):
+                related = []
+                for o in objs:
+                    v = o.__dict__[first]
+                    if rel.many:
+                        related.extend(v)
+                    elif v is not None:
+                        related.append(v)
+            else:
+                related = rel.prefetch(objs)
+            if rest and related:
+                rel.target.prefetch(related, rest)
+        return objs
+
+    @classmethod
+    def __find(cls, tn, args, join, fields, order_by, limit, related=(), **kwargs):
         is_o = not fields
         fields = fields or cls._rows
-        if order_by:
-            order_by = ' ORDER BY ' + order_by
-        if limit != '':  # 避免limit=0的bug
-            limit = ' LIMIT ' + str(limit)
-        table = cls._table_name if join else ''
-        re_str, values = _rebuild_argv(kwargs, args=args, rows=cls._rows, table=table)
-        join_sql = ''
+        shape = _argv_shape(kwargs)
+
+        def build():
+            _order_by = ' ORDER BY ' + order_by if order_by else ''
+            _limit = ' LIMIT ' + str(limit) if limit != '' else ''  # 避免limit=0的bug
+            table = cls._table_name if join or related else ''
+            re_str, plan = _compile_argv(shape, args[0] if args else None, rows=cls._rows, table=table)
+            select_sql, join_sql = cls._select_sql(fields, table, related)
+            if join:
+                if re_str and join[1]:
+                    re_str += ' AND '
+                re_str = ''.join((re_str, join[1]))
+                join_sql += join[0]
+            _where = ''.join((' WHERE ', re_str)) if re_str else ''
+            sql = ''.join(
+                ('SELECT ', select_sql, ' FROM `', tn, '` ', join_sql, _where
+                 , _order_by, _limit)
+            )
+            return sql, plan
+        key = ('find', tn, shape, args[0] if args else None, tuple(join[:2]) if join else None,
+               _fields_key(fields), order_by, limit, related)
+        sql, plan = cls._compiled(key, build)
+        values = _bind_argv(plan, kwargs)
+        if args:
+            values.extend(args[1])
         if join:
-            if re_str and join[1]:
-                re_str += ' AND '
-            re_str = ''.join((re_str, join[1]))
             values.extend(join[2])
-            join_sql = join[0]
-        _where = ''.join((' WHERE ', re_str)) if re_str else ''
-        sql = ''.join(
-            ('SELECT ', list_to_sql(fields, table=table), ' FROM `', tn, '` ', join_sql, _where
-             , order_by, limit)
-        )
         return sql, values, is_o
 
     @classmethod
-    def find(cls, args=None, join=None, fields=None, order_by='', limit='', commit=True, **kwargs):
+    def find(cls, args=None, join=None, fields=None, order_by='', limit='', commit=True, select_related=(),
+             prefetch_related=(), only=None, defer=None, cache=None, columnar=False, **kwargs):
         """ 根据条件获取多个对象, 返回对象列表, 支持单张连表
             exam: find(id=id, name=name) -- and
+            select_related: 用 LEFT JOIN 在同一条语句中加载的 ForeignKey 关联名
+            prefetch_related: 查询后每个关联再用一条 IN 语句批量加载, 支持 'last_answer__user' 形式的嵌套
+            only/defer: 只查询部分列(或不查询某些列)仍返回对象, 任一对象第一次访问未加载的列时,
+                用一条 IN 语句为整批对象加载; dictify 只输出已加载的列
+            cache: True 或过期秒数时使用查询结果缓存, 见 _query_cache
+            columnar: 返回 OrderedDict {列名: 数组}, 不创建行字典和对象, 适合大结果集的统计
+                有 numpy 时为 ndarray, 否则整数/浮点列为 array.array, 其他列为 list, 类型取自游标描述
+                时间列为对象数组; 为 'datetime64' 时(需要 numpy)时间列转为 datetime64
         """
+        related = cls._related_names(select_related, fields)
+        fields, deferred = cls._projection(fields, only, defer)
         sql, values, is_o = cls.__find(tn=cls._table_name, args=args, join=join, fields=fields,
-                                       order_by=order_by, limit=limit, **kwargs)
+                                       order_by=order_by, limit=limit, related=related, **kwargs)
         if not commit:
             return sql, values
-        _db_con = cls.get_conn()
-        ds = _execute_sql(sql, values, db_con=_db_con, mode='query', echo=cls._echo)
-        return [cls(o) for o in ds] if is_o else ds
+        if columnar:
+            if related or prefetch_related or deferred:
+                raise SqlValueError('columnar can not be used with select_related/prefetch_related/only/defer')
+            return cls._fetch_columns(sql, values, datetime64=columnar == 'datetime64')
+        ds = cls._cached_read(sql, values, 'query', cache)
+        return cls._load_related(ds, related, prefetch_related, deferred) if is_o or deferred else cls._rows_out(ds)
 
     @classmethod
-    def find_iter(cls, args=None, join=None, fields=None, order_by='', limit='', **kwargs):
-        """ 数据迭代器
+    def _rows_out(cls, ds):
+        """ 返回字典行; 来自查询结果缓存的行需要复制, 避免调用方修改缓存
         """
-        sql, values, is_o = cls.__find(tn=cls._table_name, args=args, join=join, fields=fields,
-                                       order_by=order_by, limit=limit, **kwargs)
-        _db_con = cls.get_conn()
-        return _execute_sql(sql, values, db_con=_db_con, mode='iter', echo=cls._echo)
+        if cls._query_cache is None:
+            return ds
+        return [type(d)(d) for d in ds]
+
+    @classmethod
+    def find_iter(cls, args=None, join=None, fields=None, order_by='', limit='', batch_size=1000, row_type='dict',
+                  keyset=False, **kwargs):
+        """ 数据迭代器, 内存占用与结果集大小无关
+            batch_size: 每次从服务端读取的行数
+            row_type: 'dict' 字典行, 'model' 对象, 'tuple' 元组(按fields顺序),
+                'columns' 每批生成一个 {列名: 数组}, 见 find 的 columnar
+            keyset: 按id分批查询, 不长时间占用一个游标, 适合耗时很长的遍历, 此时按id排序且不支持join
+            return: RowStream
+        """
+        types = []
+        if keyset:
+            gen = cls._keyset_batches(args, join, fields, limit, batch_size, kwargs)
+        else:
+            sql, values, is_o = cls.__find(tn=cls._table_name, args=args, join=join, fields=fields,
+                                           order_by=order_by, limit=limit, **kwargs)
+            _db_con = cls.get_read_conn()
+            gen = _stream_batches(sql=sql, values=values, db_con=_db_con, batch_size=batch_size, echo=cls._echo,
+                                  types=types)
+        return RowStream(cls._stream_rows(gen, row_type, types))
+
+    @classmethod
+    def scan_partitions(cls, partitions, args=None, boundaries='minmax', partition_rows=None, **kwargs):
+        """ 按id范围把满足条件的数据分为最多 partitions 个区间
+            boundaries: 'minmax' 按 MIN(id)/MAX(id) 等分, id 不连续时各区间行数可能相差很大
+                        'sample' 按随机采样的id分位数划分, 采样需要扫描一遍索引
+            partition_rows: 每个区间的行数上限, 按估算行数(不超过id跨度)增加区间数
+            return: [(lo, hi), ...], 没有数据时为空列表
+        """
+        re_str, values = _rebuild_argv(kwargs, args=args, rows=cls._rows)
+        _where = ''.join((' WHERE ', re_str)) if re_str else ''
+        sql = ''.join(('SELECT MIN(`id`) AS lo, MAX(`id`) AS hi FROM `', cls._table_name, '`', _where))
+        r = cls._execute_read(sql, values, mode='get')
+        if not r or r['lo'] is None:
+            return []
+        lo, hi = int(r['lo']), int(r['hi'])
+        total = None
+        if partition_rows or boundaries == 'sample':
+            count_sql, count_values = cls.number(args=args, commit=False, **kwargs)
+            total = cls._estimate_count(count_sql, count_values)
+        if partition_rows:
+            # 无法估算时以id跨度为行数上限
+            rows = hi - lo + 1 if total is None else min(total, hi - lo + 1)
+            partitions = max(partitions, -(-rows // partition_rows))
+        if boundaries == 'minmax':
+            return _split_range(lo, hi, partitions)
+        if boundaries != 'sample':
+            raise SqlValueError('bad boundaries: %r' % boundaries)
+        total = total or cls.number(args=args, **kwargs)
+        # 每个分区约100个样本
+        rate = min(1.0, partitions * 100.0 / max(total, 1))
+        _where = ''.join((' WHERE ', re_str, ' AND ')) if re_str else ' WHERE '
+        sql = ''.join(('SELECT `id` FROM `', cls._table_name, '`', _where, 'RAND() < %s'))
+        samples = [int(d['id']) for d in cls._execute_read(sql, list(values) + [rate], mode='query')]
+        return _split_samples(lo, hi, samples, partitions)
+
+    @classmethod
+    def parallel_scan(cls, partitions=None, workers=4, args=None, fields=None, row_type='model', ordered=False,
+                      boundaries='minmax', retries=2, progress=None, executor=None, partition_rows=100000,
+                      **kwargs):
+        """ 并行导出大表: 按id范围分区, 每个分区一条语句, 在线程池(或传入的进程池)中各用一个连接执行
+            partitions: 最少分区数, 默认为 workers*4, 分区越小内存占用越小、失败重试的代价越小
+            partition_rows: 每个分区的行数上限, 见 scan_partitions; 每个分区整体读入内存,
+                同时最多约 2*workers*partition_rows 行, None 时只按 partitions 划分
+            workers: 自建线程池的线程数, 传入 executor 时不使用
+            fields/args/kwargs: 同 find, row_type 为 'model' 时 fields 作为 only
+            row_type: 'model' 对象, 'dict' 字典行, 'columns' {列名: 数组}(见 find 的 columnar)
+            ordered: True 按id顺序生成各分区的结果, 否则先完成的先生成
+            boundaries: 同 scan_partitions
+            retries: 分区失败后的重试次数, 用完后抛出异常
+            progress: 每个分区完成后调用 progress(info),
+                info: {'partition', 'lo', 'hi', 'rows', 'attempts', 'done', 'total', 'elapsed'}
+            executor: concurrent.futures 的线程池或进程池; 使用进程池时模型需能按模块路径 pickle,
+                且每个进程要在 fork 之后建立自己的连接
+            return: RowStream, 每次生成一个分区的结果; 提前关闭时取消未开始的分区
+                同时提交的分区数不超过线程数的两倍, 消费者取走结果后再提交后面的分区
+            线程池中 _db_conn 必须是 ConnectionPool, 每条语句单独借还连接
+        """
+        if row_type not in ('model', 'dict', 'columns'):
+            raise SqlValueError('bad row_type: %r' % row_type)
+        if 'id__between' in kwargs:
+            raise SqlValueError('parallel_scan uses id__between for partitions')
+        from concurrent.futures import ThreadPoolExecutor
+        if executor is None or isinstance(executor, ThreadPoolExecutor):
+            con = cls.get_read_conn()
+            if not isinstance(con, ConnectionPool):
+                raise SqlValueError('parallel_scan in threads needs a ConnectionPool, got %r' % con)
+        ranges = cls.scan_partitions(partitions or workers * 4, args=args, boundaries=boundaries,
+                                     partition_rows=partition_rows, **kwargs)
+        return RowStream(cls._parallel_scan(ranges, workers, args, fields, row_type, ordered, retries, progress,
+                                            executor, kwargs))
 
     @classmethod
-    def all(cls, fields=None, order_by='', limit='', commit=True):
+    def _parallel_scan(cls, ranges, workers, args, fields, row_type, ordered, retries, progress, executor, kwargs):
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        own = executor is None
+        if own:
+            executor = ThreadPoolExecutor(workers)
+        start = time.time()
+        attempts = [0] * len(ranges)
+        pending = {}
+        results = {}
+        todo = deque(range(len(ranges)))
+        # 执行中和等待按序生成的分区总数不超过 window, 消费者跟不上时不再提交新分区
+        window = 2 * getattr(executor, '_max_workers', workers)
+
+        def submit(i):
+            attempts[i] += 1
+            lo, hi = ranges[i]
+            pending[executor.submit(_scan_partition, cls, lo, hi, row_type, fields, args, kwargs)] = i
+
+        def fill():
+            while todo and len(pending) + len(results) < window:
+                submit(todo.popleft())
+
+        try:
+            fill()
+            done_count = 0
+            next_i = 0
+            while pending:
+                finished, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+                for f in finished:
+                    i = pending.pop(f)
+                    try:
+                        rows = f.result()
+                    except Exception as ex:
+                        if attempts[i] > retries:
+                            raise
+                        logging.warning('[HqOrm scan]: %s partition %s %r retry %s', cls._table_name, ranges[i],
+                                        ex, attempts[i])
+                        submit(i)
+                        continue
+                    done_count += 1
+                    if progress:
+                        n = len(rows[next(iter(rows))]) if row_type == 'columns' and rows else len(rows)
+                        progress({'partition': i, 'lo': ranges[i][0], 'hi': ranges[i][1], 'rows': n,
+                                  'attempts': attempts[i], 'done': done_count, 'total': len(ranges),
+                                  'elapsed': time.time() - start})
+                    if ordered:
+                        results[i] = rows
+                    else:
+                        yield rows
+                        fill()
+                while ordered and next_i in results:
+                    yield results.pop(next_i)
+                    next_i += 1
+                fill()
+        finally:
+            for f in pending:
+                f.cancel()
+            if own:
+                executor.shutdown(wait=False)
+
+    @classmethod
+    def _fetch_columns(cls, sql, values, datetime64=False):
+        """ 用服务端游标分批读取, 直接按列填充数组
+        """
+        types = []
+        builder = _ColumnBuilder(types, datetime64=datetime64)
+        for names, batch in _stream_batches(cls.get_read_conn(), sql, values, _COLUMN_BATCH, echo=cls._echo,
+                                            types=types):
+            builder.add(names, batch)
+        return builder.result()
+
+    @classmethod
+    def _keyset_batches(cls, args, join, fields, limit, batch_size, kwargs):
+        """ 用 seek 按id分批查询, 每批单独执行
+        """
+        if join:
+            raise SqlValueError('keyset iteration does not support join')
+        left = int(limit) if limit != '' else None
+        cursor = None
+        while left is None or left > 0:
+            size = batch_size if left is None else min(batch_size, left)
+            ds, cursor = cls.seek(cursor, order_by='id', per_page=size, args=args, fields=fields or cls._rows,
+                                  **kwargs)
+            if ds:
+                names = list(ds[0].keys())
+                yield names, [tuple([d[k] for k in names]) for d in ds]
+            if left is not None:
+                left -= len(ds)
+            if not cursor:
+                break
+
+    @classmethod
+    def _stream_rows(cls, gen, row_type, types=None):
+        try:
+            if row_type == 'tuple':
+                for names, batch in gen:
+                    for row in batch:
+                        yield row
+            elif row_type == 'columns':
+                for names, batch in gen:
+                    builder = _ColumnBuilder(types)
+                    builder.add(names, batch)
+                    yield builder.result()
+            else:
+                row_cls = _row_class()
+                for names, batch in gen:
+                    ds = [row_cls(zip(names, row)) for row in batch]
+                    if row_type == 'model':
+                        ds = cls._from_rows(ds)
+                    for d in ds:
+                        yield d
+        finally:
+            gen.close()
+
+    @classmethod
+    def all(cls, fields=None, order_by='', limit='', commit=True, only=None, defer=None, cache=None,
+            columnar=False):
+        fields, deferred = cls._projection(fields, only, defer)
         is_o = not fields
         fields = fields or cls._rows
         if order_by:
@@ -368,107 +3110,257 @@ class Base(object):
         )
         if not commit:
             return sql, []
-        _db_con = cls.get_conn()
-        ds = _execute_sql(sql, [], db_con=_db_con, mode='query', echo=cls._echo)
-        return [cls(d) for d in ds] if is_o else ds
+        if columnar:
+            return cls._fetch_columns(sql, [], datetime64=columnar == 'datetime64')
+        ds = cls._cached_read(sql, [], 'query', cache)
+        return cls._defer(cls._from_rows(ds), deferred) if is_o or deferred else cls._rows_out(ds)
 
     @classmethod
-    def __page(cls, tn, page, args, join, fields, order_by, per_page, **kwargs):
+    def __page(cls, tn, page, args, join, fields, order_by, per_page, related=(), **kwargs):
         is_o = not fields
         fields = fields or cls._rows
 
         page = int(page)
         page = max(page-1, 0)
         beg = page * per_page
-        if order_by:
-            order_by = ' ORDER BY ' + order_by
-        table = cls._table_name if join else ''
-        re_str, values = _rebuild_argv(kwargs, args=args, rows=cls._rows, table=table)
-        join_sql = ''
+        shape = _argv_shape(kwargs)
+
+        def build():
+            _order_by = ' ORDER BY ' + order_by if order_by else ''
+            table = cls._table_name if join or related else ''
+            re_str, plan = _compile_argv(shape, args[0] if args else None, rows=cls._rows, table=table)
+            select_sql, join_sql = cls._select_sql(fields, table, related)
+            if join:
+                if re_str and join[1]:
+                    re_str += ' AND '
+                re_str = re_str + join[1]
+                join_sql += join[0]
+            _where = ''.join((' WHERE ', re_str)) if re_str else ''
+            sql = ''.join(
+                ('SELECT ', select_sql, ' FROM `', tn, '` ', join_sql, _where,
+                 _order_by, ' LIMIT %s OFFSET %s')
+            )
+            return sql, plan
+        key = ('page', tn, shape, args[0] if args else None, tuple(join[:2]) if join else None,
+               _fields_key(fields), order_by, related)
+        sql, plan = cls._compiled(key, build)
+        values = _bind_argv(plan, kwargs)
+        if args:
+            values.extend(args[1])
         if join:
-            if re_str and join[1]:
-                re_str += ' AND '
-            re_str = re_str + join[1]
             values.extend(join[2])
-            join_sql = join[0]
-        _where = ''.join((' WHERE ', re_str)) if re_str else ''
-        page_limit = ' LIMIT %s OFFSET %s' % (per_page, beg)
-        sql = ''.join(
-            ('SELECT ', list_to_sql(fields, table=table), ' FROM `', tn, '` ', join_sql, _where,
-             order_by, page_limit)
-        )
+        # 分页参数作为绑定值, 不同页数共用同一条编译好的sql
+        values.extend((per_page, beg))
         return sql, values, is_o
 
     @classmethod
-    def page(cls, page, args=None, join=None, fields=None, order_by='', per_page=None, commit=True, **kwargs):
+    def page(cls, page, args=None, join=None, fields=None, order_by='', per_page=None, commit=True,
+             select_related=(), prefetch_related=(), only=None, defer=None, cache=None, **kwargs):
         """ 页数从第1页开始, 支持单张连表
             page: 页数
             args: and, or支持
             join: join exp [table, join_col, table.col]
             fields: 连表获取的列字符串 exam: 'items.*'
+            select_related/prefetch_related/only/defer/cache: 同 find
             kwargs: 限制条件
         """
-        per_page = per_page or cls.per_page
+        per_page = int(per_page or cls.per_page)
+        related = cls._related_names(select_related, fields)
+        fields, deferred = cls._projection(fields, only, defer)
+        sql, values, is_o = cls.__page(tn=cls._table_name, page=page, args=args, join=join, fields=fields,
+                                       order_by=order_by, per_page=per_page, related=related, **kwargs)
+        if not commit:
+            return sql, values
+        ds = cls._cached_read(sql, values, 'query', cache)
+        return cls._load_related(ds, related, prefetch_related, deferred) if is_o or deferred else cls._rows_out(ds)
+
+    @classmethod
+    def paginate(cls, page, per_page=None, count='exact', args=None, fields=None, order_by='', select_related=(),
+                 prefetch_related=(), only=None, defer=None, **kwargs):
+        """ 分页并返回总数, 代替 page 之后再调用 number
+            每页多取一行判断是否有下一页; 最后一页(含第1页不满一页)直接由偏移算出总数, 不再计数
+            count: 'exact' 每次 COUNT(*)
+                   'cached' 计数按条件缓存 _count_ttl 秒, 本模型的写操作使缓存失效
+                   'approx' EXPLAIN 估算的行数不小于 _approx_threshold 时使用估算值, 否则精确计数
+                   'has_next' 不计数, 总数为 None
+            select_related/prefetch_related/only/defer: 同 find
+            return: (对象列表, 总数, 是否有下一页)
+        """
+        if count not in ('exact', 'cached', 'approx', 'has_next'):
+            raise SqlValueError('bad count mode: %r' % count)
+        per_page = int(per_page or cls.per_page)
+        related = cls._related_names(select_related, fields)
+        fields, deferred = cls._projection(fields, only, defer)
+        sql, values, is_o = cls.__page(tn=cls._table_name, page=page, args=args, join=None, fields=fields,
+                                       order_by=order_by, per_page=per_page, related=related, **kwargs)
+        # 最后两个绑定值是 LIMIT 和 OFFSET
+        values[-2] = per_page + 1
+        ds = cls._execute_read(sql, values, mode='query')
+        has_next = len(ds) > per_page
+        ds = ds[:per_page]
+        offset = values[-1]
+        if count == 'has_next':
+            total = None
+        elif not has_next and (ds or not offset):
+            total = offset + len(ds)
+        else:
+            total = cls._count(count, args, kwargs)
+        items = cls._load_related(ds, related, prefetch_related, deferred) if is_o or deferred else ds
+        return items, total, has_next
+
+    @classmethod
+    def seek(cls, cursor=None, order_by='id', per_page=None, desc=False, args=None, fields=None, commit=True,
+             **kwargs):
+        """ 游标分页, 用上一页最后一行的排序列定位, 翻到多深都和第一页开销相同
+            cursor: 上一页返回的游标, None 为第一页
+            order_by: 排序列名, 多列用逗号分隔或列表, 自动追加 id 保证顺序唯一
+            desc: 是否倒序
+            return: (对象列表, 下一页游标), 没有下一页时游标为 None
+        """
+        per_page = int(per_page or cls.per_page)
+        if isinstance(order_by, (str, unicode)):
+            order_by = [c.strip().strip('`') for c in order_by.split(',') if c.strip()]
+        cols = list(order_by)
+        if 'id' not in cols:
+            cols.append('id')
         is_o = not fields
         fields = fields or cls._rows
-
-        page = int(page)
-        page = max(page-1, 0)
-        beg = page * per_page
-        if order_by:
-            order_by = ' ORDER BY ' + order_by
-        table = cls._table_name if join else ''
-        re_str, values = _rebuild_argv(kwargs, args=args, rows=cls._rows, table=table)
-        join_sql = ''
-        if join:
-            if re_str and join[1]:
-                re_str += ' AND '
-            re_str = re_str + join[1]
-            values.extend(join[2])
-            join_sql = join[0]
-        _where = ''.join((' WHERE ', re_str)) if re_str else ''
-        page_limit = ' LIMIT %s OFFSET %s' % (per_page, beg)
-        sql = ''.join(
-            ('SELECT ', list_to_sql(fields, table=table), ' FROM `', cls._table_name, '` ', join_sql, _where,
-             order_by, page_limit)
-        )
+        if not is_o and not isinstance(fields, (str, unicode)):
+            # 需要取出排序列来生成下一页游标
+            fields = list(fields) + [c for c in cols if c not in fields]
+        shape = _argv_shape(kwargs)
+
+        def build():
+            if not set(cols).issubset(set(cls._rows)):
+                raise BuildArgsError(''.join((str(cols), '<>', str(cls._rows))))
+            re_str, plan = _compile_argv(shape, args[0] if args else None, rows=cls._rows)
+            conds = [re_str] if re_str else []
+            if cursor:
+                conds.append(''.join(('(', list_to_sql(cols), ') ', '<' if desc else '>',
+                                      ' (', ','.join(['%s'] * len(cols)), ')')))
+            _where = ''.join((' WHERE ', ' AND '.join(conds))) if conds else ''
+            direction = ' DESC' if desc else ''
+            _order_by = ','.join(['`' + c + '`' + direction for c in cols])
+            sql = ''.join(
+                ('SELECT ', list_to_sql(fields), ' FROM `', cls._table_name, '`', _where,
+                 ' ORDER BY ', _order_by, ' LIMIT %s')
+            )
+            return sql, plan
+        key = ('seek', cls._table_name, shape, args[0] if args else None, _fields_key(fields), tuple(cols),
+               bool(desc), bool(cursor))
+        sql, plan = cls._compiled(key, build)
+        values = _bind_argv(plan, kwargs)
+        if args:
+            values.extend(args[1])
+        if cursor:
+            last = decode_cursor(cursor)
+            if len(last) != len(cols):
+                raise SqlValueError('bad cursor: %r' % cursor)
+            values.extend(last)
+        # 多取一行判断是否还有下一页
+        values.append(per_page + 1)
         if not commit:
             return sql, values
-        # sql, values, is_o = cls.__page(tn=cls._table_name, page=page, args=args, join=join,
-        #                                fields=fields, order_by=order_by, per_page=per_page, **kwargs)
-        _db_con = cls.get_conn()
-        ds = _execute_sql(sql, values, db_con=_db_con, mode='query', echo=cls._echo)
-        return [cls(o) for o in ds] if is_o else ds
+        ds = cls._execute_read(sql, values, mode='query')
+        next_cursor = None
+        if len(ds) > per_page:
+            ds = ds[:per_page]
+            next_cursor = encode_cursor([ds[-1][c] for c in cols])
+        return (cls._from_rows(ds) if is_o else ds), next_cursor
 
     @classmethod
     def delete(cls, args=None, commit=True, **kwargs):
         """ 删除相关对象, 直接生效, 谨慎操作
         """
-        re_str, values = _rebuild_argv(kwargs, args=args, rows=cls._rows)
-        sql = ''.join(
-            ('DELETE FROM `', cls._table_name, '` WHERE ', re_str)
-        )
-        # sql, values = cls.__delete(tn=cls._table_name, args=args, **kwargs)
+        shape = _argv_shape(kwargs)
+
+        def build():
+            re_str, plan = _compile_argv(shape, args[0] if args else None, rows=cls._rows)
+            sql = ''.join(
+                ('DELETE FROM `', cls._table_name, '` WHERE ', re_str)
+            )
+            return sql, plan
+        sql, plan = cls._compiled(('delete', cls._table_name, shape, args[0] if args else None), build)
+        values = _bind_argv(plan, kwargs)
+        if args:
+            values.extend(args[1])
         if not commit:
             return sql, values
-        _db_con = cls.get_conn()
-        return _execute_sql(sql, values, db_con=_db_con, mode='execute_rowcount', echo=cls._echo)
+        return cls._execute_write(sql, values, mode='execute_rowcount', rows=cls._id_rows(kwargs, args))
 
     @classmethod
-    def number(cls, args=None, commit=True, **kwargs):
+    def number(cls, args=None, commit=True, cache=None, **kwargs):
         """ 计数
+            cache: 同 find
         """
-        re_str, values = _rebuild_argv(kwargs, args=args, rows=cls._rows)
-        _where = ''.join((' WHERE ', re_str)) if re_str else ''
-        sql = ''.join(
-            ('SELECT COUNT(*) FROM `', cls._table_name, '` ', _where)
-        )
-        # sql, values = cls.__number(tn=cls._table_name, args=args, **kwargs)
+        shape = _argv_shape(kwargs)
+
+        def build():
+            re_str, plan = _compile_argv(shape, args[0] if args else None, rows=cls._rows)
+            _where = ''.join((' WHERE ', re_str)) if re_str else ''
+            sql = ''.join(
+                ('SELECT COUNT(*) FROM `', cls._table_name, '` ', _where)
+            )
+            return sql, plan
+        sql, plan = cls._compiled(('number', cls._table_name, shape, args[0] if args else None), build)
+        values = _bind_argv(plan, kwargs)
+        if args:
+            values.extend(args[1])
         if not commit:
             return sql, values
-        _db_con = cls.get_conn()
-        result = _execute_sql(sql, values, db_con=_db_con, mode='query', echo=cls._echo)
-        return int(result[0].get('COUNT(*)', 0)) if result else 0
+        result = cls._cached_read(sql, values, 'get', cache)
+        return int(result.get('COUNT(*)', 0)) if result else 0
+
+    @classmethod
+    def _count(cls, count, args, kwargs):
+        """ 按计数方式取总数, 见 paginate
+        """
+        sql, values = cls.number(args=args, commit=False, **kwargs)
+        state = cls._state()
+        if count == 'approx':
+            n = cls._estimate_count(sql, values)
+            if n is not None and n >= cls._approx_threshold:
+                state.count_stats['approx'] += 1
+                return n
+            return cls.number(args=args, **kwargs)
+        if count == 'exact':
+            return cls.number(args=args, **kwargs)
+        key = (sql, tuple(values))
+        n = state.counts.get(key)
+        if n is not None:
+            state.count_stats['hits'] += 1
+            return n
+        state.count_stats['misses'] += 1
+        version = state.version
+        n = cls.number(args=args, **kwargs)
+        # 计数期间有写操作或在事务中时不缓存
+        if state.version == version and not _in_transaction():
+            state.counts.set(key, n)
+        return n
+
+    @classmethod
+    def _estimate_count(cls, sql, values):
+        """ 用 EXPLAIN 的 rows*filtered 估算满足条件的行数, 无法估算时返回 None
+        """
+        sql = 'EXPLAIN ' + sql.replace('SELECT COUNT(*)', 'SELECT 1', 1)
+        try:
+            plan = cls._execute_read(sql, values, mode='get')
+        except Exception as ex:
+            logging.warning('[HqOrm approx count]: %s %r', cls._table_name, ex)
+            return None
+        if not plan or plan.get('rows') is None:
+            return None
+        filtered = plan.get('filtered')
+        filtered = 100.0 if filtered is None else float(filtered)
+        return int(int(plan['rows']) * filtered / 100)
+
+    @classmethod
+    def count_cache_info(cls):
+        """ paginate 计数统计: hits/misses(count='cached') 及 approx(使用估算值的次数)
+        """
+        info = dict(cls._state().count_stats)
+        info.update(size=len(cls._state().counts))
+        return info
 
     @classmethod
     def cls_update(cls, sets=None, args=None, commit=True, **kwargs):
@@ -485,21 +3377,148 @@ class Base(object):
         sql = ''.join(
             ('UPDATE `', cls._table_name, '` SET ', set_keys, _where)
         )
-        # set_values.extend(values)
-        vs = values[::]
-        vs.extend(set_values)
+        # UPDATE 本身会锁定匹配的行, 不需要先 select ... for update
+        vs = list(set_values)
         vs.extend(values)
-        sql = 'select id from ' + cls._table_name + _where + ' for update;' + sql
-        _db_con = cls.get_conn()
         if not commit:
             return sql, vs
-        return _execute_sql(sql, vs, db_con=_db_con, mode='execute_rowcount', echo=cls._echo)
+        return cls._execute_write(sql, vs, mode='execute_rowcount', rows=cls._id_rows(kwargs, args))
 
     @classmethod
     def execute_sql(cls, sql, values, mode):
-        _db_con = cls.get_conn()
+        _db_con = cls._primary_conn()
         return _execute_sql(sql, values, db_con=_db_con, mode=mode, echo=cls._echo)
 
+    # 异步方法, 返回 Future, 在 tornado 协程中使用: q = yield Question.aget(id=1)
+    # 没有非阻塞驱动时在线程池中执行, 连接必须是 ConnectionPool
+    @classmethod
+    def aexecute_sql(cls, sql, values, mode, read=False):
+        _db_con = cls.get_read_conn() if read else cls._primary_conn()
+        return _aexecute_sql(sql, values, db_con=_db_con, mode=mode, echo=cls._echo, executor=cls._executor)
+
+    @classmethod
+    def _aexecute_write(cls, sql, values, mode='execute', rows=None):
+        """ 异步执行写语句, 执行前后通知缓存
+            回调在执行线程中运行, 写入时间记在发起调用的线程上, 之后的读在窗口内走主库
+        """
+        cls._write_started()
+        writes = _last_writes()
+        if cls._db_replicas is not None and cls._ryw_window:
+            writes[cls] = time.time()
+        future = cls.aexecute_sql(sql, values, mode=mode)
+        future.add_done_callback(lambda f: cls._on_write(rows, writes=writes))
+        return future
+
+    @classmethod
+    def _hydrate(cls, is_o):
+        """ 返回把查询结果转换为对象的函数
+        """
+        def wrap(ds):
+            return cls._from_rows(ds) if is_o else ds
+        return wrap
+
+    @classmethod
+    def aget(cls, fields=None, **kwargs):
+        """ 异步 get
+        """
+        sql, values = cls.get(fields=fields, commit=False, **kwargs)
+        return _chain_future(cls.aexecute_sql(sql, values, mode='get', read=True),
+                             lambda o: cls(o) if not fields and o else o)
+
+    @classmethod
+    def afind(cls, args=None, join=None, fields=None, order_by='', limit='', **kwargs):
+        """ 异步 find
+        """
+        sql, values = cls.find(args=args, join=join, fields=fields, order_by=order_by, limit=limit,
+                               commit=False, **kwargs)
+        return _chain_future(cls.aexecute_sql(sql, values, mode='query', read=True), cls._hydrate(not fields))
+
+    @classmethod
+    def apage(cls, page, args=None, join=None, fields=None, order_by='', per_page=None, **kwargs):
+        """ 异步 page
+        """
+        sql, values = cls.page(page, args=args, join=join, fields=fields, order_by=order_by,
+                               per_page=per_page, commit=False, **kwargs)
+        return _chain_future(cls.aexecute_sql(sql, values, mode='query', read=True), cls._hydrate(not fields))
+
+    @classmethod
+    def anumber(cls, args=None, **kwargs):
+        """ 异步 number
+        """
+        sql, values = cls.number(args=args, commit=False, **kwargs)
+        return _chain_future(cls.aexecute_sql(sql, values, mode='get', read=True),
+                             lambda r: int(r.get('COUNT(*)', 0)) if r else 0)
+
+    @classmethod
+    def anew(cls, refetch=None, **kwargs):
+        """ 异步 new, 返回新建的对象
+        """
+        if not kwargs:
+            return None
+        if refetch is None:
+            refetch = cls._refetch_on_new
+        xid = kwargs.get('id')
+        sql, values = cls.new(commit=False, **kwargs)
+        max_try = 3
+        writes = _last_writes()
+
+        def insert(tried):
+            future = cls._aexecute_write(sql, values, mode='execute', rows=[kwargs])
+            out = _new_future()
+
+            def done(f):
+                try:
+                    out.set_result(f.result())
+                except Exception as ex:
+                    if ex.args and ex.args[0] == 1062 and tried + 1 < max_try:
+                        insert(tried + 1).add_done_callback(lambda r: _copy_future(r, out))
+                    else:
+                        out.set_exception(ex)
+            future.add_done_callback(done)
+            return out
+
+        def get_primary(nid, fields=None):
+            # 回调在执行线程中运行, 该线程没有写入记录, 明确在主库查询, 避免读到未同步的从库
+            sql, values = cls.get(fields=fields, commit=False, id=nid)
+            return _chain_future(cls.aexecute_sql(sql, values, mode='get'),
+                                 lambda o: cls(o) if not fields and o else o)
+
+        def fetch(nid):
+            if not xid:
+                cls._on_write([{'id': nid}], writes=writes)
+            nid = xid or nid
+            if refetch:
+                return get_primary(nid)
+            missing = [k for k in cls._default_rows if k not in kwargs]
+            if not missing:
+                return cls._from_insert(kwargs, nid)
+            return _chain_future(get_primary(nid, missing), lambda d: cls._from_insert(kwargs, nid, d))
+        return _chain_future(insert(0), fetch)
+
+    def aupdate(self, **kwargs):
+        """ 异步 update
+        """
+        if not kwargs:
+            future = _new_future()
+            future.set_result(self)
+            return future
+        sql, values = self.update(commit=False, **kwargs)
+
+        def done(rows):
+            if rows:
+                self._set_saved(kwargs)
+            return self
+        future = self._aexecute_write(sql, values, mode='execute_rowcount', rows=self._cache_rows(kwargs))
+        return _chain_future(future, done)
+
+    def asave(self):
+        """ 异步 save
+        """
+        data = self.changed_data()
+        if not data:
+            self.be_clean()
+        return self.aupdate(**data)
+
     def __update(self, tn, **kwargs):  # 必须带上至少一个差异性参数 kwargs 带有self.id
         re_str, values = _rebuild_argv(kwargs, args=None, rows=self._rows, link=' , ')
         re_str = re_str.replace('(', '').replace(')', '')  # update 语句不可包含括号
@@ -523,25 +3542,145 @@ class Base(object):
         if not commit:
             return sql, values
         # sql, values = self.__update(tn=self._table_name, **kwargs)
-        _db_con = self.get_conn()
-        # try:
-        rows = _execute_sql(sql, values, db_con=_db_con, mode='execute_rowcount', echo=self._echo)
+        rows = self._execute_write(sql, values, mode='execute_rowcount', rows=self._cache_rows(kwargs))
         if rows:
             # 更新成功, 设置新的属性
-            for k in kwargs:
-                self.__setattr__(k, kwargs[k])
-            self.__dirty_data.clear()
+            self._set_saved(kwargs)
         return self
 
+    def _cache_rows(self, data):
+        """ 更新前后的列值, 用于使缓存失效
+        """
+        orig = dict((k, v) for k, v in self._changed.items() if v is not _MISSING)
+        return [self, orig, data]
+
+    def _set_saved(self, data):
+        """ 设置已保存到数据库的值, 这些列不再是脏数据
+        """
+        changed = self._changed
+        for k in data:
+            object.__setattr__(self, k, data[k])
+            changed.pop(k, None)
+
+    def changed_data(self):
+        """ 与原始值不同的列, 返回 {列: 当前值}
+        """
+        data = {}
+        for k, orig in self._changed.items():
+            v = getattr(self, k, _MISSING)
+            if v is not _MISSING and v != orig:
+                data[k] = v
+        return data
+
     def save(self):
-        """ 保存更改到数据库
+        """ 保存更改到数据库, 没有实际改动时不执行sql
         """
-        self.update(**self.__dirty_data)
-        self.__dirty_data.clear()
+        data = self.changed_data()
+        if data:
+            self.update(**data)
+        self.be_clean()
         return self
 
     def be_clean(self):
-        self.__dirty_data.clear()
+        self._changed.clear()
+
+    @classmethod
+    def save_all(cls, instances, commit=True):
+        """ 批量保存多个对象的改动, 按改动的列分组, 每组用一条 UPDATE ... CASE id WHEN 语句
+            return: 执行的sql语句数, commit=False 时返回 (sql, values) 列表
+        """
+        groups = OrderedDict()
+        for o in instances:
+            data = o.changed_data()
+            if data:
+                groups.setdefault(tuple(sorted(data)), []).append((o, data))
+            else:
+                o.be_clean()
+        stmts = []
+        for keys, items in groups.items():
+            for i in range(0, len(items), cls._batch_size):
+                chunk = items[i:i + cls._batch_size]
+                sets = []
+                values = []
+                for k in keys:
+                    sets.append('`' + k + '`=CASE `id`' + ' WHEN %s THEN %s' * len(chunk) + ' END')
+                    for o, data in chunk:
+                        values.extend((o.id, data[k]))
+                values.extend([o.id for o, _ in chunk])
+                sql = ''.join(
+                    ('UPDATE `', cls._table_name, '` SET ', ','.join(sets), ' WHERE `id` IN (',
+                     ','.join(['%s'] * len(chunk)), ')')
+                )
+                stmts.append((sql, values, chunk))
+        if not commit:
+            return [(sql, values) for sql, values, _ in stmts]
+        for sql, values, chunk in stmts:
+            rows = []
+            for o, data in chunk:
+                rows.extend(o._cache_rows(data))
+            cls._execute_write(sql, values, mode='execute_rowcount', rows=rows)
+            for o, data in chunk:
+                o._set_saved(data)
+        return len(stmts)
+
+    @classmethod
+    def incr(cls, id, commit=True, **deltas):
+        """ 原子增减计数列, 不需要先查询, 也不需要 select ... for update
+            Question.incr(qid, answer_count=1, max_answer_like=-1)
+            id: id 或 id 列表
+            return: 影响的行数
+        """
+        if not deltas:
+            return 0
+        cols = sorted(deltas)
+        for col in cols:
+            if col not in cls._row_set:
+                raise SqlValueError('unknown column: %s' % col)
+        ids = list(id) if isinstance(id, (list, tuple, set)) else [id]
+        if not ids:
+            return 0 if commit else ('', [])
+
+        def build():
+            sets = ','.join(['`%s`=`%s`+%%s' % (col, col) for col in cols])
+            return ''.join(
+                ('UPDATE `', cls._table_name, '` SET ', sets, ' WHERE `id` IN (', ','.join(['%s'] * len(ids)), ')')
+            )
+        sql = cls._compiled(('incr', cls._table_name, tuple(cols), len(ids)), build)
+        values = [deltas[col] for col in cols]
+        values.extend(ids)
+        if not commit:
+            return sql, values
+        return cls._execute_write(sql, values, mode='execute_rowcount', rows=[{'id': i} for i in ids])
+
+    @classmethod
+    def incr_many(cls, deltas, commit=True):
+        """ 批量增减计数, 每 _batch_size 个id一条 UPDATE ... CASE id WHEN 语句, 供 CounterBuffer 使用
+            deltas: {id: {列: 增量}}
+            return: 执行的sql语句数, commit=False 时返回 (sql, values) 列表
+        """
+        items = [(i, cols) for i, cols in deltas.items() if cols]
+        stmts = []
+        for n in range(0, len(items), cls._batch_size):
+            chunk = items[n:n + cls._batch_size]
+            cols = sorted(set(col for _, c in chunk for col in c))
+            sets = []
+            values = []
+            for col in cols:
+                whens = [(i, c[col]) for i, c in chunk if col in c]
+                sets.append('`%s`=`%s`+CASE `id`%s ELSE 0 END' % (col, col, ' WHEN %s THEN %s' * len(whens)))
+                for i, delta in whens:
+                    values.extend((i, delta))
+            values.extend([i for i, _ in chunk])
+            sql = ''.join(
+                ('UPDATE `', cls._table_name, '` SET ', ','.join(sets), ' WHERE `id` IN (',
+                 ','.join(['%s'] * len(chunk)), ')')
+            )
+            stmts.append((sql, values, chunk))
+        if not commit:
+            return [(sql, values) for sql, values, _ in stmts]
+        for sql, values, chunk in stmts:
+            cls._execute_write(sql, values, mode='execute_rowcount', rows=[{'id': i} for i, _ in chunk])
+        return len(stmts)
 
     def dictify(self, fields=None, properties=None, convert_date=True, convert_fun=str):
         """ 对象数据包装, 返回字典
@@ -549,14 +3688,25 @@ class Base(object):
         if properties is None:
             properties = []
         data = {}
-        for k, v in self.__dict__.items():
+        relations = self._relations
+        items = [(k, v) for k, v in ((k, _slot_value(self, k)) for k in self._rows) if v is not _MISSING]
+        items.extend(self.__dict__.items())
+        for k, v in items:
             if fields and k in fields:
                 data[k] = v
-            elif not k.startswith('_') and fields is None:
+            elif not k.startswith('_') and fields is None and k not in relations:
                 data[k] = v
         for attr in properties:
             if hasattr(self, attr) and attr not in data:
                 data[attr] = getattr(self, attr)
+        for k in data:
+            # 关联对象只在 fields/properties 中指定时输出, 转换为字典
+            if k in relations and data[k] is not None:
+                v = data[k]
+                if relations[k].many:
+                    data[k] = [o.dictify(convert_date=convert_date, convert_fun=convert_fun) for o in v]
+                else:
+                    data[k] = v.dictify(convert_date=convert_date, convert_fun=convert_fun)
         # 设置时间字段为时间戳
         if convert_date:
             for k in data:
@@ -564,3 +3714,74 @@ class Base(object):
                 if isinstance(v, (datetime.datetime, datetime.date)):
                     data[k] = convert_fun(v)
         return data
+
+    @classmethod
+    def _column_getter(cls, col):
+        """ 读取列值的函数, 未加载时抛出 AttributeError, 不触发延迟加载
+        """
+        desc = getattr(cls, col, None)
+        if isinstance(desc, types.MemberDescriptorType):
+            return desc.__get__
+        return lambda o: object.__getattribute__(o, col)
+
+    @classmethod
+    def dictify_many(cls, objs, fields=None, properties=None, convert_date=True, convert_fun=str):
+        """ 批量 dictify, 每个对象的结果与 dictify 相同
+            要输出的列、读取列的方式和时间转换函数每次调用只准备一次, 不必逐个对象重复
+            return: 字典列表
+        """
+        properties = properties or []
+        relations = cls._relations
+        if fields is None:
+            cols = [k for k in cls._rows if not k.startswith('_') and k not in relations]
+        else:
+            cols = [k for k in cls._rows if fields and k in fields]
+        getters = [(k, cls._column_getter(k)) for k in cols]
+        # 只有 fields 为 None 或包含非列名时才需要读取实例字典
+        extras = fields is None or any(k not in cls._row_set for k in fields)
+        rels = [k for k in list(fields or ()) + list(properties) if k in relations]
+        # 按类型缓存时间转换函数, 每个值只需一次字典查找
+        converters = {}
+        result = []
+        for o in objs:
+            data = {}
+            for k, get in getters:
+                try:
+                    data[k] = get(o)
+                except AttributeError:
+                    pass
+            if extras:
+                for k, v in o.__dict__.items():
+                    if fields and k in fields:
+                        data[k] = v
+                    elif fields is None and not k.startswith('_') and k not in relations:
+                        data[k] = v
+            for attr in properties:
+                if attr not in data:
+                    v = getattr(o, attr, _MISSING)
+                    if v is not _MISSING:
+                        data[attr] = v
+            for k in rels:
+                v = data.get(k)
+                if v is not None:
+                    if relations[k].many:
+                        data[k] = [r.dictify(convert_date=convert_date, convert_fun=convert_fun) for r in v]
+                    else:
+                        data[k] = v.dictify(convert_date=convert_date, convert_fun=convert_fun)
+            if convert_date:
+                for k, v in data.items():
+                    t = type(v)
+                    conv = converters.get(t, _MISSING)
+                    if conv is _MISSING:
+                        conv = converters[t] = convert_fun if issubclass(t, (datetime.datetime, datetime.date)) \
+                            else None
+                    if conv is not None:
+                        data[k] = conv(v)
+            result.append(data)
+        return result
+
+    @classmethod
+    def dumps_many(cls, objs, fields=None, properties=None, convert_fun=str):
+        """ 对象列表直接序列化为 JSON 字节串, 时间按 convert_fun 转换, 其他无法序列化的值转为字符串
+        """
+        return _json_encoder.encode(cls.dictify_many(objs, fields, properties, True, convert_fun))